@@ -0,0 +1,134 @@
+# Copyright 2017 ContextLabs B.V.
+
+import heapq
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+from omi_api.client import recording_pb2, work_pb2
+from omi_api.indexes import StateIndex
+
+
+# Roles a party can have in a split.
+CONTRIBUTOR = 'contributor'
+SONGWRITER = 'songwriter'
+PUBLISHER = 'publisher'
+
+
+class SplitAggregates(StateIndex):
+    """
+    Royalty split totals per party, maintained incrementally from the
+    contributor splits of recordings and the songwriter publisher splits of
+    works.
+
+    For every (role, name) the splits are kept by address together with a
+    running sum and count, so totals are answered without a scan and a changed
+    recording or work only updates the parties it names.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.refresh_interval = settings.OMI_INDEX_REFRESH_INTERVAL
+        # address -> [(role, name, split)]
+        self._rows = {}
+        # (role, name) -> {address: (title, split)}
+        self._splits = defaultdict(dict)
+        # (role, name) -> [sum, count]
+        self._totals = defaultdict(lambda: [0, 0])
+
+    @property
+    def message_types(self):
+        return recording_pb2.Recording, work_pb2.Work
+
+    def _rows_for(self, obj):
+        if isinstance(obj, recording_pb2.Recording):
+            for split in obj.contributor_splits:
+                yield CONTRIBUTOR, split.contributor_name, split.split
+        else:
+            for split in obj.songwriter_publisher_splits:
+                yield SONGWRITER, split.songwriter_publisher.songwriter_name, split.split
+                yield PUBLISHER, split.songwriter_publisher.publisher_name, split.split
+
+    def add(self, address, obj):
+        rows = list(self._rows_for(obj))
+        for role, name, split in rows:
+            key = (role, name)
+            splits = self._splits[key]
+            # A party named twice on the same item has the splits added up,
+            # and the item counted once.
+            counted = address in splits
+            _, previous = splits.get(address, (None, 0))
+            splits[address] = (obj.title, previous + split)
+            totals = self._totals[key]
+            totals[0] += split
+            totals[1] += 0 if counted else 1
+        self._rows[address] = rows
+
+    def remove(self, address):
+        for role, name, split in self._rows.pop(address, ()):
+            key = (role, name)
+            splits = self._splits.get(key)
+            if not splits or address not in splits:
+                continue
+            title, total_split = splits.pop(address)
+            totals = self._totals[key]
+            totals[0] -= total_split
+            totals[1] -= 1
+            if not splits:
+                del self._splits[key]
+                del self._totals[key]
+
+    def summary(self, role, name, limit=10, include=None):
+        """
+        Returns the sum and count of the splits of a party in a role and its
+        `limit` largest splits. `include` is called with the title of every
+        item and filters which ones are counted.
+        """
+        with self._lock:
+            splits = list(self._splits.get((role, name), {}).values())
+            if include is None:
+                total, count = self._totals.get((role, name), (0, 0))
+            else:
+                splits = [(title, split) for title, split in splits if include(title)]
+                total, count = sum(split for _, split in splits), len(splits)
+        top = heapq.nlargest(limit, splits, key=lambda row: row[1])
+        return {
+            'count': count,
+            'total': total,
+            'top': [{'title': title, 'split': split} for title, split in top],
+        }
+
+    def ranking(self, role, limit=10, include=None):
+        """
+        Returns the `limit` parties with the largest split sum in a role.
+        `include` is called with the name of every party and filters which
+        ones are ranked.
+        """
+        with self._lock:
+            totals = [
+                (name, total, count)
+                for (_role, name), (total, count) in self._totals.items()
+                if _role == role and (include is None or include(name))
+            ]
+        top = heapq.nlargest(limit, totals, key=lambda row: row[1])
+        return {
+            'count': len(totals),
+            'top': [{'name': name, 'total': total, 'count': count} for name, total, count in top],
+        }
+
+
+_split_aggregates = None
+_split_aggregates_lock = threading.Lock()
+
+
+def get_split_aggregates():
+    """
+    Returns the process wide SplitAggregates.
+    """
+    global _split_aggregates
+    with _split_aggregates_lock:
+        if _split_aggregates is None:
+            _split_aggregates = SplitAggregates()
+            _split_aggregates.snapshot_file = settings.OMI_SNAPSHOT_FILE
+        return _split_aggregates
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class OmiApiConfig(AppConfig):
     name = 'omi_api'
+
+    def ready(self):
+        from omi_api import checks  # noqa: F401
@@ -0,0 +1,163 @@
+# Copyright 2017 ContextLabs B.V.
+
+import time
+import threading
+import urllib
+from collections import OrderedDict
+
+import requests
+
+from omi_api.breaker import CircuitOpenError, get_breaker
+
+
+class Endpoint:
+    """
+    A REST API host with its circuit breaker, the number of requests in flight
+    and an exponentially weighted moving average of its response time.
+    """
+    # Weight of the latest response time in the moving average.
+    decay = 0.3
+
+    def __init__(self, url):
+        self.name = urllib.parse.urlparse(url).netloc
+        self.breaker = get_breaker(url)
+        self.outstanding = 0
+        self.latency = None
+        self._lock = threading.Lock()
+
+    def score(self):
+        """
+        Expected wait for a new request, lower is better. Endpoints without
+        measurements come first so they get measured.
+        """
+        return (self.latency or 0) * (self.outstanding + 1)
+
+    def request(self, method, url, allowance=0, **kwargs):
+        with self._lock:
+            self.outstanding += 1
+        start = time.time()
+        measured = True
+        try:
+            return self.breaker.request(method, url, allowance=allowance, **kwargs)
+        except CircuitOpenError:
+            measured = False
+            raise
+        finally:
+            elapsed = max(0, time.time() - start - allowance)
+            with self._lock:
+                self.outstanding -= 1
+                if measured:
+                    if self.latency is None:
+                        self.latency = elapsed
+                    else:
+                        self.latency += self.decay * (elapsed - self.latency)
+
+
+# Error code of the Sawtooth REST API for a block id it does not know.
+HEAD_NOT_FOUND = 50
+
+
+def is_head_not_found(r):
+    """
+    Returns whether the response says the REST API does not have the requested
+    block, e.g. because its validator has not caught up yet.
+    """
+    if r.status_code != 404:
+        return False
+    try:
+        return r.json()['error']['code'] == HEAD_NOT_FOUND
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+# Base url of the REST API each recently seen block id was read from, so
+# reads pinned to the block go there first.
+_head_urls = OrderedDict()
+_head_urls_lock = threading.Lock()
+HEAD_URLS_SIZE = 1024
+
+
+def remember_head(head, url):
+    if not head or not url:
+        return
+    with _head_urls_lock:
+        _head_urls[head] = url
+        _head_urls.move_to_end(head)
+        while len(_head_urls) > HEAD_URLS_SIZE:
+            _head_urls.popitem(last=False)
+
+
+def get_head_url(head):
+    with _head_urls_lock:
+        return _head_urls.get(head)
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoint(url):
+    """
+    Returns the process wide Endpoint for the host of the url.
+    """
+    name = urllib.parse.urlparse(url).netloc
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(url)
+        return _endpoints[name]
+
+
+class EndpointPool:
+    """
+    Spreads requests over the REST APIs of several validators.
+
+    Requests go to the endpoint with the lowest score among those whose circuit
+    is not open. Endpoints that refuse connections or keep failing are ejected
+    by their circuit breaker until it probes them again.
+    """
+
+    def __init__(self, urls):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.endpoints = [get_endpoint(url) for url in self.urls]
+
+    def choose_url(self, exclude=()):
+        """
+        Returns the base url of the best endpoint not in `exclude`. When all
+        circuits are open the best one is returned anyway, and calling it fails
+        fast with CircuitOpenError.
+        """
+        candidates = [
+            (endpoint, url) for endpoint, url in zip(self.endpoints, self.urls)
+            if url not in exclude
+        ]
+        available = [(endpoint, url) for endpoint, url in candidates if endpoint.breaker.available()]
+        endpoint, url = min(available or candidates, key=lambda candidate: candidate[0].score())
+        return url
+
+    def request(self, method, path, head=None, **kwargs):
+        """
+        Makes an idempotent request to the best endpoint, and to the next best
+        ones while it fails with a connection error, timeout, open circuit or
+        server error, or does not have the block `head` the request is pinned
+        to. The endpoint the block was read from is tried first. The base url
+        of the endpoint that answered is set as `endpoint_url` on the response.
+        """
+        tried = []
+        preferred = get_head_url(head) if head else None
+        while True:
+            if not tried and preferred in self.urls:
+                url = preferred
+            else:
+                url = self.choose_url(exclude=tried)
+            tried.append(url)
+            last = len(tried) == len(self.urls)
+            try:
+                r = get_endpoint(url).request(method, url + path, **kwargs)
+            except (CircuitOpenError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if last:
+                    raise
+                continue
+            if (r.status_code >= 500 or is_head_not_found(r)) and not last:
+                continue
+            r.endpoint_url = url
+            return r
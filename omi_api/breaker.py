@@ -0,0 +1,173 @@
+# Copyright 2017 ContextLabs B.V.
+
+import time
+import threading
+import urllib
+from collections import deque
+
+import requests
+from django.conf import settings
+
+from omi_api.exceptions import OMIError
+
+
+class CircuitOpenError(OMIError):
+    """
+    Raised instead of calling a REST API whose circuit is open. `retry_after`
+    is the number of seconds until the next probe is let through.
+    """
+
+    def __init__(self, name, retry_after):
+        super().__init__("Circuit for %s is open" % name)
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops calling a REST API that is failing or slow.
+
+    The outcome of the last `window` calls is recorded. Once at least
+    `min_calls` were made and the share of failed calls reaches `error_rate`,
+    or the share of calls taking longer than `slow_call` seconds reaches
+    `slow_rate`, the circuit opens and calls fail fast with CircuitOpenError.
+    After `reset_timeout` seconds the circuit is half-open and a single probe
+    call is let through, which closes the circuit again when it is quick and
+    successful, and reopens it otherwise. Calls that were made before the
+    circuit opened and finish later do not count.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=20, min_calls=5, error_rate=0.5, slow_call=2.0, slow_rate=0.5, reset_timeout=10):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._calls = deque(maxlen=window)
+        self._probe = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self._calls.clear()
+
+    def retry_after(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def available(self):
+        """
+        Returns whether a call would be let through now.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return self.retry_after() <= 0
+            return not (self.state == self.HALF_OPEN and self._probe is not None)
+
+    def _is_late(self, probe):
+        """
+        Returns whether the outcome of a call must be ignored: while the circuit
+        is open, and while it is half-open for any call but the probe.
+        """
+        if self.state == self.OPEN:
+            return True
+        return self.state == self.HALF_OPEN and (probe is None or probe is not self._probe)
+
+    def trip(self, probe=None):
+        """
+        Opens the circuit straight away, e.g. when the host refused a connection.
+        `probe` is the token returned by allow() for the call.
+        """
+        with self._lock:
+            if self._is_late(probe):
+                return
+            self._probe = None
+            self._open()
+
+    def allow(self):
+        """
+        Raises CircuitOpenError if a call must not be made now. Returns a token
+        when the call is the probe of a half-open circuit, and None otherwise.
+        Pass it on to record() or trip().
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self.retry_after()
+                if retry_after > 0:
+                    raise CircuitOpenError(self.name, retry_after)
+                self.state = self.HALF_OPEN
+                self._probe = None
+            if self.state == self.HALF_OPEN:
+                if self._probe is not None:
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._probe = object()
+                return self._probe
+            return None
+
+    def record(self, duration, failed, allowance=0, probe=None):
+        """
+        Records the outcome of a call. `allowance` is the time the call was
+        expected to wait on the server, e.g. for a long poll, and does not
+        count as slow. `probe` is the token returned by allow() for the call.
+        """
+        slow = duration - allowance >= self.slow_call
+        with self._lock:
+            if self._is_late(probe):
+                return
+            if self.state == self.HALF_OPEN:
+                self._probe = None
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                return
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slow_calls = sum(1 for _, slow in self._calls if slow)
+            if failures >= self.error_rate * len(self._calls) or slow_calls >= self.slow_rate * len(self._calls):
+                self._open()
+
+    def request(self, method, url, allowance=0, **kwargs):
+        """
+        Makes a request through the breaker. Server errors, timeouts and
+        connection errors count as failures, and a refused connection opens
+        the circuit straight away.
+        """
+        probe = self.allow()
+        start = time.time()
+        try:
+            r = requests.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            self.trip(probe)
+            raise
+        except Exception:
+            self.record(time.time() - start, True, allowance, probe)
+            raise
+        self.record(time.time() - start, r.status_code >= 500, allowance, probe)
+        return r
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url):
+    """
+    Returns the process wide CircuitBreaker for the host of the url, configured
+    with OMI_CIRCUIT_BREAKER.
+    """
+    name = urllib.parse.urlparse(url).netloc
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **getattr(settings, 'OMI_CIRCUIT_BREAKER', {}))
+        return _breakers[name]
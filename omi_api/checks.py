@@ -0,0 +1,23 @@
+# Copyright 2017 ContextLabs B.V.
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+# Cache backends that are not shared between worker processes.
+PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(deploy=True)
+def check_admission_pools(app_configs, **kwargs):
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.OMI_ADMISSION_POOLS and backend in PROCESS_CACHES:
+        return [Warning(
+            "OMI_ADMISSION_POOLS are enforced per worker process with %s." % backend,
+            hint="Set OMI_CACHE_BACKEND to a cache shared by the workers of the host, e.g. memcached.",
+            id='omi_api.W001',
+        )]
+    return []
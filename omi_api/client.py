@@ -1,67 +1,210 @@
 # Copyright 2017 ContextLabs B.V.
 
+import os
+import sys
 import time
+import types
+import threading
 import hashlib
 import urllib
-import requests
-import sawtooth_signing as signing
+import importlib.util
 from base64 import b64decode
 from random import randint
-from sawtooth_omi.protobuf.work_pb2 import Work
-from sawtooth_omi.protobuf.recording_pb2 import Recording
-from sawtooth_omi.protobuf.identity_pb2 import IndividualIdentity
-from sawtooth_omi.protobuf.identity_pb2 import OrganizationalIdentity
-from sawtooth_omi.protobuf.txn_payload_pb2 import OMITransactionPayload
-
-from sawtooth_omi.handler import FAMILY_NAME, OMI_ADDRESS_PREFIX, make_omi_address, _get_address_infix
-from sawtooth_omi.handler import WORK, RECORDING, INDIVIDUAL, ORGANIZATION
-
-from sawtooth_sdk.protobuf.batch_pb2 import Batch
-from sawtooth_sdk.protobuf.batch_pb2 import BatchHeader
-from sawtooth_sdk.protobuf.batch_pb2 import BatchList
-from sawtooth_sdk.protobuf.transaction_pb2 import Transaction
-from sawtooth_sdk.protobuf.transaction_pb2 import TransactionHeader
-
-
-TAG_MAP = {
-    OrganizationalIdentity: ORGANIZATION,
-    Recording: RECORDING,
-    Work: WORK,
-    IndividualIdentity: INDIVIDUAL,
+
+from omi_api.balancer import EndpointPool, get_endpoint, remember_head
+
+
+class MissingModule(types.ModuleType):
+    """
+    Stands in for a module that is not installed.
+    """
+    def __getattr__(self, attr):
+        raise ImportError("No module named %r" % self.__name__,
+                          name=self.__name__)
+
+
+def lazy_import(name):
+    """
+    Returns the module, which is only loaded on first attribute access. Keeps
+    the signing, protobuf and transaction family modules out of the worker boot.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:
+        spec = None
+    if spec is None:
+        # Raise on first use rather than on boot, so the read only profile
+        # runs without the signing module installed.
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+signing = lazy_import('sawtooth_signing')
+handler = lazy_import('sawtooth_omi.handler')
+work_pb2 = lazy_import('sawtooth_omi.protobuf.work_pb2')
+recording_pb2 = lazy_import('sawtooth_omi.protobuf.recording_pb2')
+identity_pb2 = lazy_import('sawtooth_omi.protobuf.identity_pb2')
+txn_payload_pb2 = lazy_import('sawtooth_omi.protobuf.txn_payload_pb2')
+batch_pb2 = lazy_import('sawtooth_sdk.protobuf.batch_pb2')
+transaction_pb2 = lazy_import('sawtooth_sdk.protobuf.transaction_pb2')
+
+
+# Name of the address tag in the handler for each message type.
+TAG_NAMES = {
+    'OrganizationalIdentity': 'ORGANIZATION',
+    'Recording': 'RECORDING',
+    'Work': 'WORK',
+    'IndividualIdentity': 'INDIVIDUAL',
 }
 
 
+def get_tag(message_type):
+    return getattr(handler, TAG_NAMES[message_type.__name__])
+
+
+def get_message_types():
+    """
+    Returns (entity type, message type) pairs, with the entity types named like
+    the API endpoints.
+    """
+    return [
+        ('works', work_pb2.Work),
+        ('recordings', recording_pb2.Recording),
+        ('individuals', identity_pb2.IndividualIdentity),
+        ('organizations', identity_pb2.OrganizationalIdentity),
+    ]
+
+
+_private_keys = {}
+_private_keys_lock = threading.Lock()
+
+
+def load_private_key(path):
+    """
+    Returns the private key stored in the file, generating it if the file does
+    not exist yet. The key is read once per process.
+    """
+    with _private_keys_lock:
+        if path not in _private_keys:
+            _private_keys[path] = _read_or_create_key(path)
+        return _private_keys[path]
+
+
+def _read_or_create_key(path):
+    if not os.path.isfile(path):
+        # Write the new key to a private file and link it into place, which
+        # fails like O_CREAT | O_EXCL when another process created the key
+        # first, without ever exposing a partly written file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(signing.generate_privkey())
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read()
+
+
+# Connect and read timeouts for calls to the Sawtooth REST API.
+DEFAULT_TIMEOUT = (3.05, 10)
+
+
+def rest_request(method, url, timeout=DEFAULT_TIMEOUT, allowance=0, **kwargs):
+    """
+    Calls the Sawtooth REST API through the circuit breaker of its host,
+    keeping track of the host's load and response time.
+    """
+    return get_endpoint(url).request(method, url, timeout=timeout, allowance=allowance, **kwargs)
+
+
 def get_object_address(name, tag):
-    return make_omi_address(name, tag)
+    return handler.make_omi_address(name, tag)
 
 
 def get_type_prefix(tag):
-    return OMI_ADDRESS_PREFIX + _get_address_infix(tag)
+    return handler.OMI_ADDRESS_PREFIX + handler._get_address_infix(tag)
+
+
+def with_head(url, head):
+    """
+    Returns the url with the `head` query parameter set, so the Sawtooth REST API
+    answers from the state at that block instead of the current chain head.
+    """
+    if not head:
+        return url
+    parts = urllib.parse.urlparse(url)
+    qs = urllib.parse.parse_qs(parts.query)
+    if qs.get('head') == [head]:
+        return url
+    qs['head'] = [head]
+    return urllib.parse.urlunparse(parts._replace(query=urllib.parse.urlencode(qs, doseq=True)))
 
 
 class Cursor:
-    def __init__(self, endpoint, message_type, count=100):
-        self.endpoint = endpoint
-        qs = urllib.parse.parse_qs(urllib.parse.urlparse(endpoint).query)
+    """
+    Iterates over the state entries under the `path` of the REST API, e.g.
+    /state?address=<prefix>.
+
+    The first page is read from the best of `endpoints`, an EndpointPool, and
+    the following ones from the REST API that served it, pinned to the block
+    it was read from. `base_url` is the url of that REST API.
+    """
+
+    def __init__(self, endpoints, path, message_type, count=100, head=None, timeout=DEFAULT_TIMEOUT):
+        self.endpoints = endpoints
+        path = with_head(path, head)
+        qs = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
         if 'count' not in qs:
             sep = '&' if qs else '?'
-            self._next = "%s%scount=%d" % (self.endpoint, sep, count)
+            self._next = "%s%scount=%d" % (path, sep, count)
         else:
-            self._next = self.endpoint
+            self._next = path
         self.message_type = message_type
+        self.head = head
+        self.base_url = None
+        self.timeout = timeout
         self.data = []
 
     def _get_page(self, url):
-        r = requests.get(url)
+        if self.base_url is None:
+            r = self.endpoints.request('GET', url, head=self.head, timeout=self.timeout)
+            self.base_url = r.endpoint_url
+        else:
+            r = rest_request('GET', url, timeout=self.timeout)
         r.raise_for_status()
         result = r.json()
+        # Pin every following page to the block the first page was read from,
+        # otherwise a long scan sees a mix of states.
+        if self.head is None:
+            self.head = result.get('head')
+            remember_head(self.head, self.base_url)
         paging = result['paging']
         if 'next' in paging:
-            self._next = paging['next']
+            self._next = with_head(paging['next'], self.head)
         else:
             self._next = None
         self.data.extend(result['data'])
 
+    def fetch_head(self):
+        """
+        Loads the first page, if not done yet, and returns the block id the
+        cursor reads from.
+        """
+        if self.head is None and self._next:
+            self._get_page(self._next)
+        return self.head
+
     def _xform(self, item):
         # item['address']
         # item['data']
@@ -78,7 +221,36 @@ class Cursor:
         raise StopIteration()
 
 
-def submit_omi_transaction(base_url, private_key, action, message_type, natural_key_field, omi_obj, additional_inputs=None):
+class EntryCursor(Cursor):
+    """
+    Cursor over the raw state entries, yielding (address, data) without
+    decoding the data.
+    """
+
+    def _xform(self, item):
+        return item['address'], b64decode(item['data'])
+
+
+def get_state_data(base_url, address, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns the data stored at the address, or None if there is none.
+    """
+    r = rest_request('GET', "%s/state/%s" % (base_url, address), timeout=timeout)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return b64decode(r.json()['data'])
+
+
+def submit_omi_transaction(base_url, private_key, action, message_type, natural_key_field, omi_obj, additional_inputs=None, timeout=DEFAULT_TIMEOUT, nonce=None, skip_unchanged=False):
+    """
+    Submits a transaction setting the object and returns its BatchStatus.
+
+    The same `nonce` yields the same transaction for the same object, so the
+    validator rejects it as a duplicate when it was submitted before. With
+    `skip_unchanged` nothing is submitted when the state already holds the
+    object, and an UnchangedStatus is returned.
+    """
     obj = message_type(**omi_obj)
 
     if additional_inputs is None:
@@ -86,11 +258,14 @@ def submit_omi_transaction(base_url, private_key, action, message_type, natural_
 
     public_key_hex = signing.generate_pubkey(private_key)
 
-    address = get_object_address(omi_obj[natural_key_field], TAG_MAP[message_type])
+    address = get_object_address(omi_obj[natural_key_field], get_tag(message_type))
 
     data = obj.SerializeToString()
 
-    payload = OMITransactionPayload(
+    if skip_unchanged and get_state_data(base_url, address, timeout=timeout) == data:
+        return UnchangedStatus()
+
+    payload = txn_payload_pb2.OMITransactionPayload(
         action=action,
         data=data,
     )
@@ -98,13 +273,13 @@ def submit_omi_transaction(base_url, private_key, action, message_type, natural_
     payload_bytes = payload.SerializeToString()
     payload_sha512 = hashlib.sha512(payload_bytes).hexdigest()
 
-    txn_header = TransactionHeader(
+    txn_header = transaction_pb2.TransactionHeader(
         batcher_pubkey=public_key_hex,
-        family_name=FAMILY_NAME,
+        family_name=handler.FAMILY_NAME,
         family_version='1.0',
         inputs=[address] + additional_inputs,
         outputs=[address],
-        nonce=str(randint(0, 1000000000)),
+        nonce=nonce if nonce is not None else str(randint(0, 1000000000)),
         payload_encoding='application/protobuf',
         payload_sha512=payload_sha512,
         signer_pubkey=public_key_hex,
@@ -120,13 +295,13 @@ def submit_omi_transaction(base_url, private_key, action, message_type, natural_
 
     # print([txn_signature_hex])
 
-    txn = Transaction(
+    txn = transaction_pb2.Transaction(
         header=txn_header_bytes,
         header_signature=txn_signature_hex,
         payload=payload_bytes,
     )
 
-    batch_header = BatchHeader(
+    batch_header = batch_pb2.BatchHeader(
         signer_pubkey=public_key_hex,
         transaction_ids=[txn.header_signature],
     )
@@ -137,13 +312,13 @@ def submit_omi_transaction(base_url, private_key, action, message_type, natural_
     batch_signature_bytes = key_handler.ecdsa_serialize_compact(batch_signature)
     batch_signature_hex = batch_signature_bytes.hex()
 
-    batch = Batch(
+    batch = batch_pb2.Batch(
         header=batch_header_bytes,
         header_signature=batch_signature_hex,
         transactions=[txn],
     )
 
-    batch_list = BatchList(batches=[batch])
+    batch_list = batch_pb2.BatchList(batches=[batch])
     batch_bytes = batch_list.SerializeToString()
 
     batch_id = batch_signature_hex
@@ -152,10 +327,10 @@ def submit_omi_transaction(base_url, private_key, action, message_type, natural_
     headers = {
         'Content-Type': 'application/octet-stream',
     }
-    r = requests.post(url, data=batch_bytes, headers=headers)
+    r = rest_request('POST', url, timeout=timeout, data=batch_bytes, headers=headers)
     r.raise_for_status()
     link = r.json()['link']
-    return BatchStatus(batch_id, link)
+    return BatchStatus(batch_id, link, timeout=timeout)
 
 
 class BatchStatus:
@@ -164,92 +339,158 @@ class BatchStatus:
     That is, whether or not the transaction has been committed to the block chain.
     """
 
-    def __init__(self, batch_id, status_url):
+    def __init__(self, batch_id, status_url, timeout=DEFAULT_TIMEOUT):
         self.batch_id = batch_id
         self.status_url = status_url
+        self.request_timeout = timeout
 
     def check(self, timeout=5):
         """
         Returns the batch status from a transaction submission. The status is one
         of ['PENDING', 'COMMITTED', 'INVALID', 'UNKNOWN'].
         """
-        r = requests.get("%s&wait=%s" % (self.status_url, timeout))
+        connect_timeout, read_timeout = self.request_timeout
+        r = rest_request(
+            'GET', "%s&wait=%s" % (self.status_url, timeout),
+            timeout=(connect_timeout, read_timeout + timeout),
+            allowance=timeout,
+        )
         r.raise_for_status()
         return r.json()['data'][self.batch_id]
 
     def wait_for_committed(self, timeout=30, check_timeout=5):
+        """
+        Waits up to `timeout` seconds while the batch is pending and returns
+        its status.
+        """
         start_time = time.time()
         while True:
-            current_time = time.time()
             status = self.check(timeout=check_timeout)
-            if status == "PENDING":
+            if status != "PENDING":
                 return status
-            if start_time + timeout >= current_time:
+            if time.time() - start_time >= timeout:
                 return status
-        return status
+
+
+class UnchangedStatus(BatchStatus):
+    """
+    Status of a write that was not submitted because the state already holds
+    the object.
+    """
+
+    def __init__(self):
+        super().__init__(None, None)
+
+    def check(self, timeout=5):
+        return "COMMITTED"
 
 
 class OMIClient:
-    def __init__(self, sawtooth_rest_url, private_key, cursor_count=100):
-        self.sawtooth_rest_url = sawtooth_rest_url
+    def __init__(self, sawtooth_rest_url, private_key=None, cursor_count=100, timeout=DEFAULT_TIMEOUT):
+        """
+        `sawtooth_rest_url` is the url of a REST API or a list of urls of the
+        REST APIs of several validators. Reads are spread over them, a write
+        and the checks of its status go to a single one.
+
+        The private key is only needed for writes and can be left out for a
+        read only client.
+        """
+        if isinstance(sawtooth_rest_url, str):
+            sawtooth_rest_url = [sawtooth_rest_url]
+        self.endpoints = EndpointPool(sawtooth_rest_url)
         self.private_key = private_key
-        self.public_key = signing.generate_pubkey(private_key)
         self.cursor_count = cursor_count
+        self.timeout = timeout
+        # Block id of the state the last single entry was read from.
+        self.head = None
+
+    @property
+    def public_key(self):
+        return signing.generate_pubkey(self.private_key)
+
+    def _endpoints(self, base_url):
+        return EndpointPool([base_url]) if base_url else self.endpoints
 
-    def _cursor(self, message_type):
-        type_prefix = get_type_prefix(TAG_MAP[message_type])
-        url = "%s/state?address=%s" % (self.sawtooth_rest_url, type_prefix)
+    def _cursor(self, message_type, head=None, base_url=None):
+        type_prefix = get_type_prefix(get_tag(message_type))
         return Cursor(
-            url,
+            self._endpoints(base_url),
+            "/state?address=%s" % type_prefix,
             message_type,
-            count=self.cursor_count
+            count=self.cursor_count,
+            head=head,
+            timeout=self.timeout,
         )
 
-    def _state_entry(self, message_type, name):
-        address = get_object_address(name, TAG_MAP[message_type])
-        url = "%s/state/%s" % (self.sawtooth_rest_url, address)
-        r = requests.get(url)
+    def get_entries(self, message_type, head=None, base_url=None):
+        """
+        Returns an EntryCursor over the entries of the message type, read from
+        the REST API at `base_url` if given, e.g. to read several types from
+        the same block.
+        """
+        type_prefix = get_type_prefix(get_tag(message_type))
+        return EntryCursor(
+            self._endpoints(base_url),
+            "/state?address=%s" % type_prefix,
+            message_type,
+            count=self.cursor_count,
+            head=head,
+            timeout=self.timeout,
+        )
+
+    def _state_entry(self, message_type, name, head=None):
+        address = get_object_address(name, get_tag(message_type))
+        url = with_head("/state/%s" % address, head)
+        r = self.endpoints.request('GET', url, head=head, timeout=self.timeout)
         r.raise_for_status()
-        data = r.json()['data']
-        return message_type.FromString(b64decode(data))
+        result = r.json()
+        self.head = result.get('head', head)
+        remember_head(self.head, r.endpoint_url)
+        return message_type.FromString(b64decode(result['data']))
 
-    def set_individual(self, individual):
+    def set_individual(self, individual, nonce=None, skip_unchanged=False):
         omi_obj = dict(individual)
         omi_obj['pubkey'] = self.public_key
         return submit_omi_transaction(
-            base_url=self.sawtooth_rest_url,
+            base_url=self.endpoints.choose_url(),
             private_key=self.private_key,
             action='SetIndividualIdentity',
-            message_type=IndividualIdentity,
+            message_type=identity_pb2.IndividualIdentity,
             natural_key_field='name',
             omi_obj=omi_obj,
+            timeout=self.timeout,
+            nonce=nonce,
+            skip_unchanged=skip_unchanged,
         )
 
-    def get_individual(self, name):
-        return self._state_entry(IndividualIdentity, name)
+    def get_individual(self, name, head=None):
+        return self._state_entry(identity_pb2.IndividualIdentity, name, head=head)
 
-    def get_individuals(self):
-        return self._cursor(IndividualIdentity)
+    def get_individuals(self, head=None):
+        return self._cursor(identity_pb2.IndividualIdentity, head=head)
 
-    def set_organization(self, organization):
+    def set_organization(self, organization, nonce=None, skip_unchanged=False):
         omi_obj = dict(organization)
         omi_obj['pubkey'] = self.public_key
         return submit_omi_transaction(
-            base_url=self.sawtooth_rest_url,
+            base_url=self.endpoints.choose_url(),
             private_key=self.private_key,
             action='SetOrganizationalIdentity',
-            message_type=OrganizationalIdentity,
+            message_type=identity_pb2.OrganizationalIdentity,
             natural_key_field='name',
             omi_obj=omi_obj,
+            timeout=self.timeout,
+            nonce=nonce,
+            skip_unchanged=skip_unchanged,
         )
 
-    def get_organization(self, name):
-        return self._state_entry(OrganizationalIdentity, name)
+    def get_organization(self, name, head=None):
+        return self._state_entry(identity_pb2.OrganizationalIdentity, name, head=head)
 
-    def get_organizations(self):
-        return self._cursor(OrganizationalIdentity)
+    def get_organizations(self, head=None):
+        return self._cursor(identity_pb2.OrganizationalIdentity, head=head)
 
-    def set_recording(self, recording):
+    def set_recording(self, recording, nonce=None, skip_unchanged=False):
         omi_obj = dict(recording)
         omi_obj['registering_pubkey'] = self.public_key
         label_name = omi_obj.get('label_name', None)
@@ -258,52 +499,58 @@ class OMIClient:
         derived_recording_splits = omi_obj.get('derived_recording_splits', [])
         references = []
         if label_name:
-            references.append(get_object_address(label_name, ORGANIZATION))
+            references.append(get_object_address(label_name, handler.ORGANIZATION))
         for split in contributor_splits:
-            references.append(get_object_address(split['contributor_name'], INDIVIDUAL))
+            references.append(get_object_address(split['contributor_name'], handler.INDIVIDUAL))
         for split in derived_work_splits:
-            references.append(get_object_address(split['work_name'], WORK))
+            references.append(get_object_address(split['work_name'], handler.WORK))
         for split in derived_recording_splits:
-            references.append(get_object_address(split['recording_name'], RECORDING))
+            references.append(get_object_address(split['recording_name'], handler.RECORDING))
 
         return submit_omi_transaction(
-            base_url=self.sawtooth_rest_url,
+            base_url=self.endpoints.choose_url(),
             private_key=self.private_key,
             action='SetRecording',
-            message_type=Recording,
+            message_type=recording_pb2.Recording,
             natural_key_field='title',
             omi_obj=omi_obj,
             additional_inputs=references,
+            timeout=self.timeout,
+            nonce=nonce,
+            skip_unchanged=skip_unchanged,
         )
 
-    def get_recording(self, title):
-        return self._state_entry(Recording, title)
+    def get_recording(self, title, head=None):
+        return self._state_entry(recording_pb2.Recording, title, head=head)
 
-    def get_recordings(self):
-        return self._cursor(Recording)
+    def get_recordings(self, head=None):
+        return self._cursor(recording_pb2.Recording, head=head)
 
-    def set_work(self, work):
+    def set_work(self, work, nonce=None, skip_unchanged=False):
         omi_obj = dict(work)
         omi_obj['registering_pubkey'] = self.public_key
         songwriter_publisher_splits = omi_obj.get('songwriter_publisher_splits', [])
         references = []
         songwriter_publishers = [split['songwriter_publisher'] for split in songwriter_publisher_splits]
         for split in songwriter_publishers:
-            references.append(get_object_address(split['songwriter_name'], INDIVIDUAL))
-            references.append(get_object_address(split['publisher_name'], ORGANIZATION))
+            references.append(get_object_address(split['songwriter_name'], handler.INDIVIDUAL))
+            references.append(get_object_address(split['publisher_name'], handler.ORGANIZATION))
 
         return submit_omi_transaction(
-            base_url=self.sawtooth_rest_url,
+            base_url=self.endpoints.choose_url(),
             private_key=self.private_key,
             action='SetWork',
-            message_type=Work,
+            message_type=work_pb2.Work,
             natural_key_field='title',
             omi_obj=omi_obj,
             additional_inputs=references,
+            timeout=self.timeout,
+            nonce=nonce,
+            skip_unchanged=skip_unchanged,
         )
 
-    def get_work(self, title):
-        return self._state_entry(Work, title)
+    def get_work(self, title, head=None):
+        return self._state_entry(work_pb2.Work, title, head=head)
 
-    def get_works(self):
-        return self._cursor(Work)
+    def get_works(self, head=None):
+        return self._cursor(work_pb2.Work, head=head)
@@ -1,5 +1,23 @@
 # Copyright 2017 ContextLabs B.V.
 
+import math
+
+from rest_framework.exceptions import APIException
+
 
 class OMIError(Exception):
     pass
+
+
+class ServiceUnavailable(APIException):
+    """
+    The gateway or the validator behind it is saturated. `wait` is sent to the
+    client in the Retry-After header.
+    """
+    status_code = 503
+    default_detail = 'Service temporarily unavailable, try again later.'
+    default_code = 'service_unavailable'
+
+    def __init__(self, detail=None, code=None, wait=None):
+        super().__init__(detail, code)
+        self.wait = math.ceil(wait) if wait is not None else None
@@ -0,0 +1,161 @@
+# Copyright 2017 ContextLabs B.V.
+
+import time
+import hashlib
+import logging
+import threading
+
+from omi_api.client import get_message_types
+from omi_api.snapshot import load_snapshot_file
+
+logger = logging.getLogger(__name__)
+
+
+def digest(data):
+    return hashlib.sha1(data).digest()
+
+
+class StateIndex:
+    """
+    Local view of the OMI state that is kept up to date incrementally.
+
+    A refresh pages through the raw state entries of `message_types` and only
+    decodes entries whose data changed since the last refresh, calling
+    `remove` for the old version and `add` for the new one. Entries that
+    disappeared are removed. Subclasses implement `add` and `remove`, and can
+    override how changes are detected with `changed` and `addresses`.
+    """
+    message_types = ()
+    # Seconds after which a refresh is started by ensure_fresh.
+    refresh_interval = 30
+    # Snapshot the first build is seeded from, if any.
+    snapshot_file = None
+
+    def __init__(self):
+        self.head = None
+        self.refreshed_at = 0
+        # Incremented whenever the changes of a refresh are applied, see read.
+        self.generation = 0
+        self._digests = {}
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+
+    def add(self, address, obj):
+        raise NotImplementedError()
+
+    def remove(self, address):
+        raise NotImplementedError()
+
+    def changed(self, address, data):
+        """
+        Returns whether the data differs from the indexed version of the entry.
+        """
+        return self._digests.get(address) != digest(data)
+
+    def addresses(self):
+        """
+        Returns the set of indexed addresses.
+        """
+        return set(self._digests)
+
+    def update(self, address, obj, data):
+        with self._lock:
+            if address in self._digests:
+                self.remove(address)
+            self.add(address, obj)
+            self._digests[address] = digest(data)
+
+    def discard(self, address):
+        with self._lock:
+            self.remove(address)
+            self._digests.pop(address, None)
+
+    def refresh(self, client, head=None):
+        """
+        Brings the index up to the state at `head`, or the current chain head.
+
+        Once the index is built, the changed entries are collected first and
+        applied together with the new head, so the index never holds a mix of
+        two blocks labelled with either of them.
+        """
+        building = self.head is None
+        changes = []
+        seen = set()
+        base_url = None
+        for message_type in self.message_types:
+            cursor = client.get_entries(message_type, head=head, base_url=base_url)
+            for address, data in cursor:
+                seen.add(address)
+                if self.changed(address, data):
+                    obj = message_type.FromString(data)
+                    if building:
+                        # Nothing is read from an index without a head.
+                        self.update(address, obj, data)
+                    else:
+                        changes.append((address, obj, data))
+            # Read all types from the same block, and from the REST API that
+            # has it.
+            head = cursor.fetch_head()
+            base_url = cursor.base_url
+        with self._lock:
+            self.generation += 1
+            for address, obj, data in changes:
+                self.update(address, obj, data)
+            for address in self.addresses() - seen:
+                self.discard(address)
+            self.head = head
+            self.refreshed_at = time.time()
+
+    def read(self, read):
+        """
+        Returns the result of calling `read` and the head it was read at. A
+        read that overlapped applying a refresh is repeated, so the result is
+        never a mix of two blocks.
+        """
+        while True:
+            with self._lock:
+                generation, head = self.generation, self.head
+            result = read()
+            if self.generation == generation:
+                return result, head
+
+    def load_snapshot(self, snapshot):
+        """
+        Seeds the index with the entries of a snapshot. The next refresh
+        catches up from the snapshot's block, decoding only the entries that
+        changed since.
+        """
+        for kind, message_type in get_message_types():
+            if message_type not in self.message_types:
+                continue
+            for address, data in snapshot.entries(kind):
+                self.update(address, message_type.FromString(data), data)
+        with self._lock:
+            self.head = snapshot.head
+            self.refreshed_at = 0
+
+    def ensure_fresh(self, client):
+        """
+        Starts building the index in the background on first use, seeded from
+        `snapshot_file` if there is one. Afterwards, when it is older than
+        `refresh_interval`, refreshes it in the background and meanwhile
+        answers from the current state. The head is None until the first build
+        is done.
+        """
+        if time.time() - self.refreshed_at >= self.refresh_interval:
+            if self._refreshing.acquire(blocking=False):
+                thread = threading.Thread(target=self._background_refresh, args=(client,))
+                thread.daemon = True
+                thread.start()
+
+    def _background_refresh(self, client):
+        try:
+            if self.head is None:
+                load_snapshot_file(self, self.snapshot_file)
+            self.refresh(client)
+        except Exception:
+            logger.exception("Refreshing %s failed", type(self).__name__)
+            # Wait for the next interval instead of retrying on every request.
+            self.refreshed_at = time.time()
+        finally:
+            self._refreshing.release()
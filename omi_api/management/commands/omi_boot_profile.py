@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Boots a worker like the WSGI server does, including the URL configuration
+# that Django otherwise loads on the first request, and reports the boot time
+# in seconds and the peak RSS as reported by getrusage.
+BOOT_SCRIPT = """
+import time
+start = time.time()
+import resource
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+class Command(BaseCommand):
+    help = "Measures the boot time and memory of a worker with the full and the read only profile."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Workers booted per profile.")
+
+    def _boot(self, read_only):
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = os.environ.get('DJANGO_SETTINGS_MODULE', 'omi_stl.settings')
+        env['OMI_READ_ONLY'] = '1' if read_only else ''
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        output = subprocess.check_output([sys.executable, '-c', BOOT_SCRIPT], env=env, cwd=settings.BASE_DIR)
+        seconds, max_rss = output.decode().split()
+        return float(seconds), int(max_rss)
+
+    def handle(self, *args, **options):
+        for name, read_only in (('full', False), ('read-only', True)):
+            samples = sorted(self._boot(read_only) for _ in range(options['runs']))
+            seconds, max_rss = samples[len(samples) // 2]
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+            unit = 'B' if sys.platform == 'darwin' else 'kB'
+            self.stdout.write("%-10s boot %6.0f ms  max RSS %d %s" % (name, seconds * 1000, max_rss, unit))
@@ -0,0 +1,62 @@
+import gc
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from omi_api.client import get_message_types
+from omi_api.router import router
+from omi_api.snapshot import Snapshot
+from omi_api.store import EntityStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the memory per entity of the entities of a snapshot, cached "
+        "as the dicts the API returns and in an EntityStore."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Snapshot written with `omi_snapshot export`.")
+
+    def _measure(self, build):
+        """
+        Returns the memory allocated by build() and still held by its result.
+        """
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = build()
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del result
+        return size
+
+    def _dicts(self, snapshot, kind, message_type, view):
+        return [view._to_json(message_type.FromString(data)) for _, data in snapshot.entries(kind)]
+
+    def _store(self, snapshot, kind, message_type):
+        store = EntityStore(message_type)
+        for address, data in snapshot.entries(kind):
+            store.put(address, message_type.FromString(data), data)
+        with store.lock:
+            store.rows()
+        return store
+
+    def handle(self, *args, **options):
+        try:
+            snapshot = Snapshot(options['path'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+        viewsets = {prefix: viewset for prefix, viewset, _ in router.registry}
+        with snapshot:
+            self.stdout.write("%-14s %10s %12s %12s" % ('', 'entities', 'dict B/item', 'store B/item'))
+            for kind, message_type in get_message_types():
+                count = snapshot.count(kind)
+                if not count:
+                    continue
+                view = viewsets[kind]()
+                dicts = self._measure(lambda: self._dicts(snapshot, kind, message_type, view))
+                store = self._measure(lambda: self._store(snapshot, kind, message_type))
+                self.stdout.write("%-14s %10d %12.0f %12.0f" % (kind, count, dicts / count, store / count))
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from omi_api.client import OMIClient
+from omi_api.search import get_search_index
+from omi_api.snapshot import Snapshot, export_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the registry at a block to a snapshot file, loads a snapshot "
+        "into the search index and catches it up, or shows what a snapshot holds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['export', 'load', 'info'])
+        parser.add_argument('path')
+        parser.add_argument('--head', help="Block id to export, defaults to the chain head.")
+
+    def _client(self):
+        return OMIClient(settings.STL_REST_URLS, timeout=settings.OMI_REST_TIMEOUT)
+
+    def _info(self, snapshot):
+        self.stdout.write("head %s" % snapshot.head)
+        for kind in sorted(snapshot.types):
+            self.stdout.write("%-14s %d" % (kind, snapshot.count(kind)))
+
+    def handle(self, *args, **options):
+        action, path = options['action'], options['path']
+        if action == 'export':
+            head = export_snapshot(self._client(), path, head=options['head'])
+            self.stdout.write("Exported the registry at %s to %s" % (head, path))
+            return
+
+        try:
+            snapshot = Snapshot(path)
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+        with snapshot:
+            self._info(snapshot)
+            if action == 'load':
+                index = get_search_index()
+                index.load_snapshot(snapshot)
+        if action == 'load':
+            index.refresh(self._client())
+            self.stdout.write("Search index caught up to %s" % index.head)
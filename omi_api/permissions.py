@@ -8,3 +8,8 @@ class IsPostAuthenticatedOrReadonly(permissions.BasePermission):
                 return True
             return False
         return request.method in permissions.SAFE_METHODS
+
+
+class IsReadOnly(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.method in permissions.SAFE_METHODS
@@ -1,5 +1,5 @@
 from rest_framework.routers import DefaultRouter, Route, DynamicListRoute, DynamicDetailRoute
-from .views import OrganizationsViewSet, WorksViewSet, IndividualsViewSet, RecordingsViewSet
+from .views import OrganizationsViewSet, WorksViewSet, IndividualsViewSet, RecordingsViewSet, SearchViewSet
 
 
 class OMIRouter(DefaultRouter):
@@ -18,7 +18,7 @@ class OMIRouter(DefaultRouter):
         # Generated using @list_route decorator
         # on methods of the viewset.
         DynamicListRoute(
-            url=r'^{prefix}/{methodname}{trailing_slash}$',
+            url=r'^{prefix}/{methodname}{trailing_slash}(;.+)?$',
             name='{basename}-{methodnamehyphen}',
             initkwargs={}
         ),
@@ -37,7 +37,7 @@ class OMIRouter(DefaultRouter):
         # Dynamically generated detail routes.
         # Generated using @detail_route decorator on methods of the viewset.
         DynamicDetailRoute(
-            url=r'^{prefix}/{lookup}/{methodname}{trailing_slash}$',
+            url=r'^{prefix}/{lookup}/{methodname}{trailing_slash}(;.+)?$',
             name='{basename}-{methodnamehyphen}',
             initkwargs={}
         ),
@@ -49,4 +49,5 @@ router.register(r'works', WorksViewSet, base_name="works")
 router.register(r'recordings', RecordingsViewSet, base_name="recordings")
 router.register(r'organizations', OrganizationsViewSet, base_name="organizations")
 router.register(r'individuals', IndividualsViewSet, base_name="individuals")
+router.register(r'search', SearchViewSet, base_name="search")
 api_urlpatterns = router.urls
@@ -0,0 +1,277 @@
+# Copyright 2017 ContextLabs B.V.
+
+import re
+import time
+import fcntl
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from omi_api.client import get_message_types
+from omi_api.indexes import StateIndex, digest
+
+
+# Entity type of each message type, named like the API endpoints.
+KINDS = {
+    'Work': 'works',
+    'Recording': 'recordings',
+    'IndividualIdentity': 'individuals',
+    'OrganizationalIdentity': 'organizations',
+}
+
+# Indexes stored with another schema are dropped and rebuilt.
+SCHEMA_VERSION = 1
+
+# `indexed` maps the addresses to the rowid of their entry, as FTS5 can only
+# look up rows by rowid or full-text match, and holds the digest of their data.
+SCHEMA = """
+DROP TABLE IF EXISTS entries;
+DROP TABLE IF EXISTS indexed;
+DROP TABLE IF EXISTS meta;
+CREATE VIRTUAL TABLE entries USING fts5(
+    name, text, kind UNINDEXED, address UNINDEXED,
+    tokenize = "unicode61 remove_diacritics 1"
+);
+CREATE TABLE indexed (address TEXT PRIMARY KEY, entry INTEGER, digest BLOB);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+PRAGMA user_version = %d;
+""" % SCHEMA_VERSION
+
+# Matches in the name weigh more than in the other text of an entity.
+RANK = "bm25(entries, 10.0, 1.0)"
+
+
+def _strings(obj):
+    """
+    Yields the string fields of a message and its nested messages, except
+    public keys.
+    """
+    for field, value in obj.ListFields():
+        if field.name.endswith('pubkey'):
+            continue
+        values = value if field.label == field.LABEL_REPEATED else [value]
+        for value in values:
+            if field.type == field.TYPE_STRING:
+                yield value
+            elif field.type == field.TYPE_MESSAGE:
+                yield from _strings(value)
+
+
+def match_expression(q):
+    """
+    Returns the FTS5 query matching entities that contain all words of `q`, each
+    as a word prefix, or None if `q` has no words. Case, diacritics and
+    punctuation are normalized by the tokenizer.
+    """
+    terms = re.findall(r'\w+', q)
+    if not terms:
+        return None
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+class SearchIndex(StateIndex):
+    """
+    Full-text index of the names and other text of works, recordings,
+    individuals and organizations, kept in a SQLite FTS5 table.
+
+    The digests of the indexed entries and the head are stored along, so a
+    restarted worker answers straight away and only catches up on changes.
+
+    The file is shared by the workers of a host. Only the worker holding the
+    lock on `<path>.lock` writes to it. While it first builds the index it
+    commits every `commit_every` updates, and later refreshes are committed
+    at once together with their head. The others answer from what was
+    committed and pick up the head it saved. Digests are looked up in
+    the file rather than kept in memory, so changes indexed by another worker
+    are not indexed again.
+    """
+    commit_every = 500
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.refresh_interval = settings.OMI_INDEX_REFRESH_INTERVAL
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._pending = 0
+        if self._schema_version() != SCHEMA_VERSION:
+            with self._writing(blocking=True):
+                # Another worker may have created it meanwhile.
+                if self._schema_version() != SCHEMA_VERSION:
+                    self._db.executescript(SCHEMA)
+        self._load_meta()
+
+    @property
+    def message_types(self):
+        return tuple(message_type for _, message_type in get_message_types())
+
+    def _schema_version(self):
+        return self._db.execute("PRAGMA user_version").fetchone()[0]
+
+    @contextmanager
+    def _writing(self, blocking):
+        """
+        Holds the lock of the writer of the index file while the block runs,
+        waiting for it if `blocking`, and yields whether it was acquired.
+        """
+        with open('%s.lock' % self.path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_meta(self):
+        with self._lock:
+            meta = dict(self._db.execute("SELECT key, value FROM meta"))
+            self.head = meta.get('head')
+            self.refreshed_at = float(meta.get('refreshed_at', 0))
+
+    def changed(self, address, data):
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM indexed WHERE address = ?", (address,)).fetchone()
+        return row is None or row[0] != digest(data)
+
+    def addresses(self):
+        with self._lock:
+            return {address for address, in self._db.execute("SELECT address FROM indexed")}
+
+    def add(self, address, obj):
+        kind = KINDS[type(obj).__name__]
+        name = obj.title if kind in ('works', 'recordings') else obj.name
+        cursor = self._db.execute(
+            "INSERT INTO entries (name, text, kind, address) VALUES (?, ?, ?, ?)",
+            (name, ' '.join(_strings(obj)), kind, address),
+        )
+        self._db.execute("INSERT OR REPLACE INTO indexed (address, entry) VALUES (?, ?)", (address, cursor.lastrowid))
+
+    def remove(self, address):
+        row = self._db.execute("SELECT entry FROM indexed WHERE address = ?", (address,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM entries WHERE rowid = ?", row)
+            self._db.execute("DELETE FROM indexed WHERE address = ?", (address,))
+
+    def _written(self):
+        self._pending += 1
+        # Nothing is read from the index before it has a head.
+        if self.head is None and self._pending >= self.commit_every:
+            self._db.commit()
+            self._pending = 0
+
+    def update(self, address, obj, data):
+        with self._lock:
+            self.remove(address)
+            self.add(address, obj)
+            self._db.execute("UPDATE indexed SET digest = ? WHERE address = ?", (digest(data), address))
+            self._written()
+
+    def discard(self, address):
+        with self._lock:
+            self.remove(address)
+            self._written()
+
+    def _save(self):
+        with self._lock:
+            if self.head is not None:
+                self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [
+                    ('head', self.head),
+                    ('refreshed_at', str(self.refreshed_at)),
+                ])
+            self._db.commit()
+            self._pending = 0
+
+    def refresh(self, client, head=None):
+        """
+        Refreshes the index unless another worker is refreshing it or did so
+        within `refresh_interval`, and otherwise picks up the head it saved.
+        The first build waits for a worker already building the index.
+        """
+        with self._writing(blocking=self.head is None) as writing:
+            self._load_meta()
+            if not writing:
+                # Check again after the next interval.
+                self.refreshed_at = time.time()
+                return
+            if head is None and self.head is not None and time.time() - self.refreshed_at < self.refresh_interval:
+                return
+            try:
+                super().refresh(client, head=head)
+            finally:
+                self._save()
+
+    def load_snapshot(self, snapshot):
+        with self._writing(blocking=True):
+            self._load_meta()
+            if self.head is not None:
+                # Another worker seeded or built the index meanwhile.
+                return
+            try:
+                super().load_snapshot(snapshot)
+            finally:
+                self._save()
+
+    @contextmanager
+    def reading(self):
+        """
+        Yields the head the index is at and keeps reading the entries at that
+        head while the block runs, even when another worker commits a refresh
+        meanwhile.
+        """
+        with self._lock:
+            if self._db.in_transaction:
+                # This worker is writing and reads its own changes.
+                yield self.head
+                return
+            self._db.execute("BEGIN")
+            try:
+                row = self._db.execute("SELECT value FROM meta WHERE key = 'head'").fetchone()
+                yield row[0] if row else None
+            finally:
+                self._db.commit()
+
+    def search(self, q, kinds=None, limit=10, offset=0):
+        """
+        Returns the total number of matches and the matches ranked from
+        `offset` to `offset + limit`, optionally only of some kinds.
+        """
+        match = match_expression(q)
+        if match is None:
+            return 0, []
+        where = "entries MATCH ?"
+        params = [match]
+        if kinds:
+            where += " AND kind IN (%s)" % ', '.join('?' * len(kinds))
+            params.extend(kinds)
+        with self._lock:
+            total = self._db.execute("SELECT count(*) FROM entries WHERE %s" % where, params).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT kind, name, address, %s AS score FROM entries WHERE %s ORDER BY score LIMIT ? OFFSET ?"
+                % (RANK, where),
+                params + [limit, offset],
+            ).fetchall()
+        return total, [
+            {'type': kind, 'name': name, 'address': address, 'score': -score}
+            for kind, name, address, score in rows
+        ]
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """
+    Returns the process wide SearchIndex stored at OMI_SEARCH_INDEX.
+    """
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(settings.OMI_SEARCH_INDEX)
+            _search_index.snapshot_file = settings.OMI_SNAPSHOT_FILE
+        return _search_index
@@ -0,0 +1,230 @@
+# Copyright 2017 ContextLabs B.V.
+"""
+Snapshots of the decoded registry at a block.
+
+A snapshot file holds the raw state entries of every entity type and can be
+memory-mapped to read them without loading the file. It is laid out as:
+
+    MAGIC
+    records of each entity type, one after the other, each
+        address     35 bytes, the 70 hex digit address in binary
+        length      varint, as in protobuf length-delimited streams
+        data        the protobuf message
+    offsets of the records of each entity type, uint64 little endian
+    header      JSON with the head and, per entity type, the offset of its
+                first record, the offset of its record offsets and the count
+    footer      offset and length of the header, uint64 and uint32 little
+                endian, followed by MAGIC
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+from array import array
+
+from omi_api.client import get_message_types
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'OMISNAP1'
+FOOTER = struct.Struct('<QI8s')
+ADDRESS_SIZE = 35
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def decode_varint(buf, pos):
+    """
+    Returns the varint at `pos` and the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _offsets_bytes(offsets):
+    offsets = array('Q', offsets)
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot, one entity type after the other.
+    """
+
+    def __init__(self, f, head):
+        self.f = f
+        self.head = head
+        self.types = {}
+        self._offsets = {}
+        self.f.write(MAGIC)
+        self._pos = len(MAGIC)
+
+    def write_entries(self, kind, entries):
+        """
+        Writes the (address, data) entries of an entity type.
+        """
+        offsets = []
+        start = self._pos
+        for address, data in entries:
+            record = bytes.fromhex(address) + encode_varint(len(data)) + data
+            offsets.append(self._pos)
+            self.f.write(record)
+            self._pos += len(record)
+        self._offsets[kind] = offsets
+        self.types[kind] = {'offset': start, 'count': len(offsets)}
+
+    def close(self):
+        for kind, offsets in self._offsets.items():
+            self.types[kind]['index'] = self._pos
+            data = _offsets_bytes(offsets)
+            self.f.write(data)
+            self._pos += len(data)
+        header = json.dumps({'version': 1, 'head': self.head, 'types': self.types}).encode()
+        self.f.write(header)
+        self.f.write(FOOTER.pack(self._pos, len(header), MAGIC))
+
+
+class Snapshot:
+    """
+    Memory-mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        """
+        Raises ValueError if the file is not a complete snapshot.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            if os.fstat(self._file.fileno()).st_size < len(MAGIC) + FOOTER.size:
+                raise ValueError("%s is not a snapshot" % path)
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        try:
+            if self._buf[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a snapshot" % path)
+            header_offset, header_length, magic = FOOTER.unpack(self._buf[-FOOTER.size:])
+            if magic != MAGIC:
+                raise ValueError("%s is truncated" % path)
+            try:
+                header = json.loads(self._buf[header_offset:header_offset + header_length].decode())
+                self.head = header['head']
+                self.types = header['types']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError("%s has a corrupt header" % path)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+    def count(self, kind):
+        return self.types.get(kind, {}).get('count', 0)
+
+    def _record(self, pos):
+        address = self._buf[pos:pos + ADDRESS_SIZE].hex()
+        length, pos = decode_varint(self._buf, pos + ADDRESS_SIZE)
+        return address, self._buf[pos:pos + length], pos + length
+
+    def entries(self, kind):
+        """
+        Yields the (address, data) entries of an entity type in file order.
+        """
+        if kind not in self.types:
+            return
+        pos = self.types[kind]['offset']
+        for _ in range(self.types[kind]['count']):
+            address, data, pos = self._record(pos)
+            yield address, data
+
+    def entry(self, kind, i):
+        """
+        Returns the (address, data) of the i-th entry of an entity type.
+        """
+        index = self.types[kind]['index']
+        pos, = struct.unpack_from('<Q', self._buf, index + 8 * i)
+        address, data, _ = self._record(pos)
+        return address, data
+
+    def messages(self, kind):
+        """
+        Yields the decoded messages of an entity type.
+        """
+        message_type = dict(get_message_types())[kind]
+        for _, data in self.entries(kind):
+            yield message_type.FromString(data)
+
+
+def export_snapshot(client, path, head=None):
+    """
+    Writes a snapshot of the state at `head`, or the current chain head, and
+    returns the block id. The file is replaced only once it is complete.
+    """
+    tmp_path = '%s.tmp' % path
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = SnapshotWriter(f, head)
+            base_url = None
+            for kind, message_type in get_message_types():
+                cursor = client.get_entries(message_type, head=head, base_url=base_url)
+                # Read all types from the same block, and from the REST API that
+                # has it.
+                head = cursor.fetch_head()
+                base_url = cursor.base_url
+                writer.head = head
+                writer.write_entries(kind, cursor)
+            writer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return head
+
+
+def load_snapshot_file(index, path):
+    """
+    Seeds an empty StateIndex from the snapshot at `path`, if there is one.
+    A snapshot that cannot be read is logged and skipped, and the index is
+    then built from the REST API on first use.
+    """
+    if index.head is not None or not path or not os.path.isfile(path):
+        return
+    try:
+        with Snapshot(path) as snapshot:
+            index.load_snapshot(snapshot)
+    except Exception:
+        # Damaged records surface as IndexError, protobuf DecodeError and the
+        # like, not only as the ValueError of a damaged header.
+        logger.exception("Loading the snapshot %s failed", path)
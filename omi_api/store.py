@@ -0,0 +1,198 @@
+# Copyright 2017 ContextLabs B.V.
+
+import threading
+
+from django.conf import settings
+
+from omi_api.client import get_message_types, get_tag, get_type_prefix
+from omi_api.indexes import StateIndex
+
+
+# Suffixes of string fields whose values repeat over many entities: names of
+# other entities, like label_name, and public keys, which are mostly the key
+# of the gateway that registered the entity.
+SHARED_SUFFIXES = ('_name', 'pubkey')
+
+
+def string_fields(message_type):
+    """
+    Returns the names of the singular string fields of a message type.
+    """
+    return tuple(
+        field.name for field in message_type.DESCRIPTOR.fields
+        if field.type == field.TYPE_STRING and field.label != field.LABEL_REPEATED
+    )
+
+
+class EntityStore:
+    """
+    Compact in-memory store of the entities of one message type.
+
+    Instead of a dict per entity, every entity is kept as its raw protobuf
+    bytes and its binary address, with the singular string fields in one
+    column list per field. Values of the fields ending in SHARED_SUFFIXES are
+    stored once per store. Entities are only decoded when they are returned.
+
+    Removed rows are blanked and dropped when the rows are next sorted.
+    """
+
+    def __init__(self, message_type):
+        self.message_type = message_type
+        self.fields = string_fields(message_type)
+        self.lock = threading.RLock()
+        self._rows = {}
+        self._addresses = []
+        self._data = []
+        self._columns = [[] for _ in self.fields]
+        self._shared = [{} if field.endswith(SHARED_SUFFIXES) else None for field in self.fields]
+        self._order = None
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def addresses(self):
+        return {address.hex() for address in self._rows}
+
+    def data(self, address):
+        """
+        Returns the raw data of the entity at the address, or None.
+        """
+        with self.lock:
+            row = self._rows.get(bytes.fromhex(address))
+            return None if row is None else self._data[row]
+
+    def put(self, address, obj, data=None):
+        with self.lock:
+            self.remove(address)
+            key = bytes.fromhex(address)
+            self._rows[key] = len(self._data)
+            self._addresses.append(key)
+            self._data.append(data if data is not None else obj.SerializeToString())
+            for field, column, shared in zip(self.fields, self._columns, self._shared):
+                value = getattr(obj, field)
+                if shared is not None:
+                    value = shared.setdefault(value, value)
+                column.append(value)
+            self._order = None
+
+    def remove(self, address):
+        with self.lock:
+            row = self._rows.pop(bytes.fromhex(address), None)
+            if row is None:
+                return
+            self._data[row] = None
+            for column in self._columns:
+                column[row] = ''
+            self._dead += 1
+            self._order = None
+
+    def _compact(self):
+        live = [row for row in range(len(self._data)) if self._data[row] is not None]
+        self._addresses = [self._addresses[row] for row in live]
+        self._data = [self._data[row] for row in live]
+        self._columns = [[column[row] for row in live] for column in self._columns]
+        self._shared = [
+            None if shared is None else {value: value for value in column}
+            for shared, column in zip(self._shared, self._columns)
+        ]
+        self._rows = {address: row for row, address in enumerate(self._addresses)}
+        self._dead = 0
+
+    def rows(self):
+        """
+        Returns the rows in address order, as the REST API lists the state.
+        Call with the lock held.
+        """
+        if self._order is None:
+            if self._dead > len(self._rows):
+                self._compact()
+            self._order = sorted(self._rows.values(), key=self._addresses.__getitem__)
+        return self._order
+
+    def values(self, row, fields):
+        """
+        Returns the non-empty values of the given fields of a row, which is
+        how they appear in the decoded entity.
+        """
+        values = {}
+        for field, column in zip(self.fields, self._columns):
+            if field in fields and column[row]:
+                values[field] = column[row]
+        return values
+
+    def get(self, row):
+        return self.message_type.FromString(self._data[row])
+
+    def messages(self):
+        """
+        Yields the decoded entities in address order.
+        """
+        with self.lock:
+            rows = list(self.rows())
+            data = list(self._data)
+        for row in rows:
+            yield self.message_type.FromString(data[row])
+
+
+class RegistryCache(StateIndex):
+    """
+    All entities of the registry in EntityStores, one per entity type,
+    kept up to date like the other local indexes.
+
+    Changes are detected by comparing with the stored data, so no digests
+    are kept per entity.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.refresh_interval = settings.OMI_INDEX_REFRESH_INTERVAL
+        self.stores = {}
+        self._prefixes = []
+        for kind, message_type in get_message_types():
+            self.stores[kind] = EntityStore(message_type)
+            self._prefixes.append((get_type_prefix(get_tag(message_type)), self.stores[kind]))
+
+    @property
+    def message_types(self):
+        return tuple(store.message_type for store in self.stores.values())
+
+    def _store(self, address):
+        for prefix, store in self._prefixes:
+            if address.startswith(prefix):
+                return store
+        raise KeyError(address)
+
+    def changed(self, address, data):
+        return self._store(address).data(address) != data
+
+    def addresses(self):
+        return set().union(*(store.addresses() for store in self.stores.values()))
+
+    def add(self, address, obj):
+        self._store(address).put(address, obj)
+
+    def remove(self, address):
+        self._store(address).remove(address)
+
+    def update(self, address, obj, data):
+        self._store(address).put(address, obj, data)
+
+    def discard(self, address):
+        self.remove(address)
+
+
+_registry_cache = None
+_registry_cache_lock = threading.Lock()
+
+
+def get_registry_cache():
+    """
+    Returns the process wide RegistryCache.
+    """
+    global _registry_cache
+    with _registry_cache_lock:
+        if _registry_cache is None:
+            _registry_cache = RegistryCache()
+            _registry_cache.snapshot_file = settings.OMI_SNAPSHOT_FILE
+        return _registry_cache
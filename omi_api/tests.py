@@ -1,3 +1,1474 @@
-from django.test import TestCase
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+import time
+import threading
+import subprocess
+import multiprocessing
+import urllib.parse
+from base64 import b64encode
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from omi_api import aggregates, client, views
+from omi_api.aggregates import CONTRIBUTOR, PUBLISHER, SONGWRITER, SplitAggregates
+from omi_api.balancer import EndpointPool, get_endpoint, remember_head
+from omi_api.breaker import CircuitBreaker, CircuitOpenError
+from omi_api.client import (
+    BatchStatus, Cursor, EntryCursor, MissingModule, UnchangedStatus, lazy_import, load_private_key, with_head,
+)
+from omi_api.exceptions import ServiceUnavailable
+from omi_api.search import SearchIndex, match_expression
+from omi_api.snapshot import Snapshot, SnapshotWriter, decode_varint, encode_varint, load_snapshot_file
+from omi_api.store import EntityStore, RegistryCache
+from omi_api.throttling import ConcurrencyPool, TokenBucketThrottle, get_pool
+from omi_api.views import IndividualsViewSet, OMISTLViewSet, SearchViewSet, WorksViewSet
+
+HEAD = 'a' * 128
+OTHER_HEAD = 'b' * 128
+
+
+def build_message_types():
+    """
+    Returns stand-ins for the OMI message types with the fields the gateway
+    uses, so the tests run without the transaction family installed.
+    """
+    field = descriptor_pb2.FieldDescriptorProto
+    string, uint32 = field.TYPE_STRING, field.TYPE_UINT32
+    # Message fields, repeated unless marked as singular.
+    messages = {
+        'Work': [
+            ('registering_pubkey', string), ('title', string), ('iswc', string),
+            ('songwriter_publisher_splits', '.omi.SongwriterPublisherSplit'),
+        ],
+        'SongwriterPublisher': [('songwriter_name', string), ('publisher_name', string)],
+        'SongwriterPublisherSplit': [('songwriter_publisher', '.omi.SongwriterPublisher', False), ('split', uint32)],
+        'Recording': [
+            ('registering_pubkey', string), ('title', string), ('isrc', string), ('label_name', string),
+            ('contributor_splits', '.omi.ContributorSplit'), ('overall_split', uint32),
+        ],
+        'ContributorSplit': [('contributor_name', string), ('split', uint32)],
+        'IndividualIdentity': [('pubkey', string), ('name', string)],
+        'OrganizationalIdentity': [('pubkey', string), ('name', string)],
+    }
+    proto = descriptor_pb2.FileDescriptorProto(name='omi_tests.proto', package='omi', syntax='proto3')
+    for name, fields in messages.items():
+        message = proto.message_type.add(name=name)
+        for number, (field_name, field_type, *repeated) in enumerate(fields, 1):
+            if isinstance(field_type, str):
+                message.field.add(
+                    name=field_name, number=number, type=field.TYPE_MESSAGE, type_name=field_type,
+                    label=field.LABEL_REPEATED if repeated != [False] else field.LABEL_OPTIONAL,
+                )
+            else:
+                message.field.add(name=field_name, number=number, type=field_type, label=field.LABEL_OPTIONAL)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    factory = message_factory.MessageFactory(pool)
+    file_descriptor = pool.FindFileByName(proto.name)
+    return {
+        name: factory.GetPrototype(descriptor)
+        for name, descriptor in file_descriptor.message_types_by_name.items()
+    }
+
+
+TYPES = build_message_types()
+Work = TYPES['Work']
+Recording = TYPES['Recording']
+IndividualIdentity = TYPES['IndividualIdentity']
+OrganizationalIdentity = TYPES['OrganizationalIdentity']
+
+HANDLER = SimpleNamespace(
+    FAMILY_NAME='omi',
+    OMI_ADDRESS_PREFIX='a0b1c2',
+    WORK='01', RECORDING='02', INDIVIDUAL='03', ORGANIZATION='04',
+    _get_address_infix=lambda tag: tag,
+    make_omi_address=lambda name, tag: 'a0b1c2' + tag + hashlib.sha512(name.encode()).hexdigest()[:62],
+)
+
+
+def address(name, tag):
+    return HANDLER.make_omi_address(name, tag)
+
+
+def work(title, *splits):
+    obj = Work(title=title, registering_pubkey='02ab')
+    for songwriter, publisher, split in splits:
+        entry = obj.songwriter_publisher_splits.add(split=split)
+        entry.songwriter_publisher.songwriter_name = songwriter
+        entry.songwriter_publisher.publisher_name = publisher
+    return obj
+
+
+def recording(title, *splits):
+    obj = Recording(title=title, registering_pubkey='02ab')
+    for contributor, split in splits:
+        obj.contributor_splits.add(contributor_name=contributor, split=split)
+    return obj
+
+
+class MessageTypesMixin:
+    """
+    Replaces the transaction family modules with the stand-ins.
+    """
+
+    def setUp(self):
+        super().setUp()
+        modules = {
+            'handler': HANDLER,
+            'work_pb2': SimpleNamespace(Work=Work),
+            'recording_pb2': SimpleNamespace(Recording=Recording),
+            'identity_pb2': SimpleNamespace(
+                IndividualIdentity=IndividualIdentity,
+                OrganizationalIdentity=OrganizationalIdentity,
+            ),
+        }
+        for module in (client, aggregates):
+            for name, fake in modules.items():
+                if name in vars(module):
+                    patcher = mock.patch.object(module, name, fake)
+                    patcher.start()
+                    self.addCleanup(patcher.stop)
+
+
+class FakeCursor:
+    def __init__(self, entries, head):
+        self.entries = entries
+        self.head = head
+        self.base_url = 'http://validator:8080'
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def fetch_head(self):
+        return self.head
+
+
+class FakeClient:
+    """
+    Serves the entries of the stand-in objects like OMIClient.get_entries.
+    """
+
+    def __init__(self, objects, head=HEAD):
+        self.head = head
+        self.calls = 0
+        self.entries = {}
+        for obj in objects:
+            tag = client.TAG_NAMES[type(obj).__name__]
+            name = obj.title if hasattr(obj, 'title') else obj.name
+            entries = self.entries.setdefault(type(obj), [])
+            entries.append((address(name, getattr(HANDLER, tag)), obj.SerializeToString()))
+
+    def get_entries(self, message_type, head=None, base_url=None):
+        self.calls += 1
+        return FakeCursor(self.entries.get(message_type, []), head or self.head)
+
+
+class BlockingClient(FakeClient):
+    """
+    Serves the entries once `release` is set, like a slow REST API.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def get_entries(self, message_type, head=None, base_url=None):
+        self.release.wait(5)
+        return super().get_entries(message_type, head=head, base_url=base_url)
+
+
+def wait_for_refresh(index):
+    with index._refreshing:
+        pass
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, url=None):
+        self.status_code = status_code
+        self.body = body if body is not None else {}
+        self.url = url
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+def page(entries, head=HEAD, next_url=None):
+    return {
+        'head': head,
+        'paging': {'next': next_url} if next_url else {},
+        'data': [{'address': a, 'data': b64encode(data).decode()} for a, data in entries],
+    }
+
+
+class WithHeadTest(SimpleTestCase):
+
+    def test_adds_head(self):
+        url = with_head('http://validator:8080/state?address=a0b1c2', HEAD)
+        self.assertEqual(urllib.parse.parse_qs(urllib.parse.urlparse(url).query), {
+            'address': ['a0b1c2'],
+            'head': [HEAD],
+        })
+
+    def test_keeps_url(self):
+        url = '/state?address=a0b1c2&head=%s' % HEAD
+        self.assertEqual(with_head(url, HEAD), url)
+        self.assertEqual(with_head('/state', None), '/state')
+
+    def test_replaces_head(self):
+        url = with_head('/state?head=%s' % OTHER_HEAD, HEAD)
+        self.assertIn('head=%s' % HEAD, url)
+        self.assertNotIn(OTHER_HEAD, url)
+
+
+class CursorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.endpoints = mock.Mock()
+        patcher = mock.patch.object(client, 'rest_request')
+        self.rest_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pins_following_pages(self):
+        first = FakeResponse(body=page([('aa', b'1')], next_url='http://v2:8080/state?address=a0&start=1'))
+        first.endpoint_url = 'http://v2:8080'
+        self.endpoints.request.return_value = first
+        self.rest_request.return_value = FakeResponse(body=page([('bb', b'2')], head=OTHER_HEAD))
+
+        cursor = EntryCursor(self.endpoints, '/state?address=a0', Work, count=1)
+        self.assertEqual(list(cursor), [('aa', b'1'), ('bb', b'2')])
+        self.assertEqual(cursor.head, HEAD)
+        self.assertEqual(cursor.base_url, 'http://v2:8080')
+        self.endpoints.request.assert_called_once_with('GET', '/state?address=a0&count=1', head=None, timeout=mock.ANY)
+        next_url = self.rest_request.call_args[0][1]
+        self.assertTrue(next_url.startswith('http://v2:8080/state?'))
+        self.assertIn('head=%s' % HEAD, next_url)
+
+    def test_requested_head(self):
+        response = FakeResponse(body=page([('aa', Work(title='Blue Moon').SerializeToString())]))
+        response.endpoint_url = 'http://v1:8080'
+        self.endpoints.request.return_value = response
+
+        cursor = Cursor(self.endpoints, '/state?address=a0', Work, head=HEAD)
+        self.assertEqual(cursor.fetch_head(), HEAD)
+        self.assertEqual([obj.title for obj in cursor], ['Blue Moon'])
+        path = self.endpoints.request.call_args[0][1]
+        self.assertIn('head=%s' % HEAD, path)
+        self.assertEqual(self.endpoints.request.call_args[1]['head'], HEAD)
+
+
+class WorkViewMixin(MessageTypesMixin):
+    """
+    Reads single works through the views, with a mock OMIClient.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.omi = mock.Mock(head=HEAD)
+        self.omi.get_work.return_value = work('Blue Moon', ('Ann', 'Acme', 50))
+        patcher = mock.patch.object(OMISTLViewSet, '_client', return_value=self.omi)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, query='', **headers):
+        request = APIRequestFactory().get('/works/Blue Moon/' + query, **headers)
+        return WorksViewSet.as_view({'get': 'retrieve'})(request, pk='Blue Moon')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReadTest(WorkViewMixin, SimpleTestCase):
+    def assertVaries(self, response):
+        self.assertIn('X-OMI-Head', response['Vary'])
+
+    def test_pinned(self):
+        response = self.get('?head=%s' % HEAD.upper())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'Blue Moon')
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertVaries(response)
+        self.omi.get_work.assert_called_once_with('Blue Moon', head=HEAD)
+
+        # Served from the cache, also when pinned with the header.
+        response = self.get(HTTP_X_OMI_HEAD=HEAD)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'Blue Moon')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(self.omi.get_work.call_count, 1)
+
+    def test_chain_head(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertNotIn('Cache-Control', response)
+        self.assertVaries(response)
+        self.omi.get_work.assert_called_once_with('Blue Moon', head=None)
+
+    def test_invalid_head(self):
+        response = self.get('?head=abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': "Invalid head 'abc'"})
+        self.assertVaries(response)
+        self.omi.get_work.assert_not_called()
+
+    def test_unknown_head(self):
+        self.omi.get_work.side_effect = requests.exceptions.HTTPError(
+            response=FakeResponse(404, {'error': {'code': 50}}))
+        response = self.get('?head=%s' % OTHER_HEAD)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data, {'error': "Unknown head %s" % OTHER_HEAD})
+        self.assertVaries(response)
+
+    def test_not_found(self):
+        self.omi.get_work.side_effect = requests.exceptions.HTTPError(
+            response=FakeResponse(404, {'error': {'code': 75}}))
+        response = self.get()
+        self.assertEqual(response.status_code, 404)
+        self.assertVaries(response)
+
+    def test_stale(self):
+        self.get()
+        self.omi.get_work.side_effect = CircuitOpenError('validator', 5)
+        with mock.patch('time.time', return_value=time.time() + 120):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'Blue Moon')
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertEqual(response['X-OMI-Stale'], '1')
+        self.assertIn('Response is Stale', response['Warning'])
+        self.assertIn(int(response['Age']), (119, 120, 121))
+        self.assertVaries(response)
+
+    def test_server_errors(self):
+        self.get()
+        for status in (500, 502, 504):
+            self.omi.get_work.side_effect = requests.exceptions.HTTPError(response=FakeResponse(status))
+            response = self.get()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['title'], 'Blue Moon')
+            self.assertEqual(response['X-OMI-Stale'], '1')
+        cache.clear()
+        response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '%d' % OMISTLViewSet.validator_retry_after)
+
+    def test_nothing_stale(self):
+        self.omi.get_work.side_effect = CircuitOpenError('validator', 5)
+        response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        # Pinned reads are never served stale.
+        self.omi.get_work.side_effect = None
+        self.get()
+        self.omi.get_work.side_effect = CircuitOpenError('validator', 5)
+        response = self.get('?head=%s' % HEAD)
+        self.assertEqual(response.status_code, 503)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenBucketThrottleTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        patcher = mock.patch.object(TokenBucketThrottle, 'THROTTLE_RATES', {'scan': '2/min', 'read': '10/sec'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def allow(self, action='list', address='10.0.0.1', user=None):
+        request = APIRequestFactory().get('/works/', REMOTE_ADDR=address)
+        # Anonymous requests have no user in the read only profile.
+        request.user = user
+        throttle = TokenBucketThrottle()
+        throttle.timer = lambda: self.now
+        allowed = throttle.allow_request(request, SimpleNamespace(action=action))
+        return allowed, throttle.wait()
+
+    def test_burst_then_refill(self):
+        self.assertEqual(self.allow(), (True, None))
+        self.assertEqual(self.allow(), (True, None))
+        allowed, wait = self.allow()
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 30)
+        self.now += 30
+        self.assertTrue(self.allow()[0])
+        self.assertFalse(self.allow()[0])
+
+    def test_buckets_per_client_and_class(self):
+        self.allow()
+        self.allow()
+        self.assertFalse(self.allow()[0])
+        self.assertTrue(self.allow(address='10.0.0.2')[0])
+        self.assertTrue(self.allow(action='retrieve')[0])
+        self.assertTrue(self.allow(action='create')[0])
+
+    def test_buckets_per_user(self):
+        user = SimpleNamespace(pk=7, is_authenticated=lambda: True)
+        self.allow(user=user)
+        self.allow(user=user)
+        self.assertFalse(self.allow(user=user, address='10.0.0.2')[0])
+        self.assertTrue(self.allow()[0])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConcurrencyPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_slots(self):
+        pool = ConcurrencyPool('tests', size=2, queue=0)
+        first = pool.acquire()
+        second = pool.acquire()
+        with self.assertRaises(ServiceUnavailable) as raised:
+            pool.acquire()
+        self.assertEqual(raised.exception.wait, 1)
+        pool.release(first)
+        pool.release(pool.acquire())
+        pool.release(second)
+
+    def test_waits_for_a_slot(self):
+        pool = ConcurrencyPool('tests', size=1, queue=1, timeout=0.2)
+        held = pool.acquire()
+        with self.assertRaises(ServiceUnavailable):
+            pool.acquire()
+        pool.release(held)
+        self.assertIsNotNone(pool.acquire())
+
+    def test_pools_per_host(self):
+        pool = ConcurrencyPool('tests', size=1)
+        other = ConcurrencyPool('tests', size=1)
+        other.host = 'other-host'
+        pool.acquire()
+        self.assertIsNotNone(other.acquire())
+
+    def test_expired_lease(self):
+        pool = ConcurrencyPool('tests', size=1)
+        held = pool.acquire()
+        # The lease ran out and another request took the slot.
+        cache.set(pool._key(held[0]), 'other')
+        pool.release(held)
+        self.assertEqual(cache.get(pool._key(held[0])), 'other')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AdmissionTest(WorkViewMixin, SimpleTestCase):
+
+    def assertReleased(self):
+        pool = get_pool('read')
+        self.assertEqual([slot for slot in range(pool.size) if cache.get(pool._key(slot))], [])
+
+    def test_released(self):
+        self.assertEqual(self.get().status_code, 200)
+        self.assertReleased()
+
+    def test_released_on_errors(self):
+        self.omi.get_work.side_effect = CircuitOpenError('validator', 5)
+        self.assertEqual(self.get().status_code, 503)
+        self.assertReleased()
+        self.omi.get_work.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            self.get()
+        self.assertReleased()
+
+    def test_rejected(self):
+        pool = get_pool('read')
+        held = [pool.acquire() for _ in range(pool.size)]
+        with mock.patch.object(pool, 'queue', 0):
+            response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '%d' % pool.retry_after)
+        for slot in held:
+            pool.release(slot)
+        self.omi.get_work.assert_not_called()
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('validator', window=4, min_calls=4, slow_call=1.0, reset_timeout=10)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.assertIsNone(self.breaker.allow())
+            self.breaker.record(0.1, True)
+
+    def expire(self):
+        self.breaker.opened_at -= self.breaker.reset_timeout
+
+    def test_opens_on_errors(self):
+        self.fail(3)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.allow()
+        self.assertGreater(raised.exception.retry_after, 9)
+        self.assertFalse(self.breaker.available())
+
+    def test_opens_on_slow_calls(self):
+        for duration in (0.1, 0.1, 1.5, 1.5):
+            self.breaker.allow()
+            self.breaker.record(duration, False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_allowance(self):
+        for _ in range(4):
+            self.breaker.allow()
+            self.breaker.record(5.5, False, allowance=5)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_closes(self):
+        self.fail(4)
+        self.expire()
+        self.assertTrue(self.breaker.available())
+        probe = self.breaker.allow()
+        self.assertIsNotNone(probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.available())
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.allow()
+        self.breaker.record(0.1, False, probe=probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_reopens(self):
+        self.fail(4)
+        self.expire()
+        probe = self.breaker.allow()
+        self.breaker.record(0.1, True, probe=probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_late_calls_ignored(self):
+        self.fail(4)
+        opened_at = self.breaker.opened_at
+        # Calls made before the circuit opened neither reset nor close it.
+        self.breaker.record(0.1, True)
+        self.assertEqual(self.breaker.opened_at, opened_at)
+        self.expire()
+        probe = self.breaker.allow()
+        self.breaker.record(0.1, False)
+        self.breaker.trip()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.record(2.0, False, probe=probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_trip(self):
+        self.breaker.trip(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+
+class EndpointPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        # Endpoints and breakers are process wide, so every test gets new hosts.
+        self.urls = ['http://%s-%d:8080' % (self._testMethodName, i) for i in range(3)]
+        self.responses = {}
+        self.calls = []
+        patcher = mock.patch.object(requests, 'request', side_effect=self.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(url)
+        response = self.responses.get(url.split('/state')[0], FakeResponse())
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def test_chooses_the_fastest(self):
+        pool = EndpointPool(self.urls)
+        for url, latency in zip(self.urls, (0.3, 0.1, 0.2)):
+            get_endpoint(url).latency = latency
+        self.assertEqual(pool.choose_url(), self.urls[1])
+        get_endpoint(self.urls[1]).outstanding = 3
+        self.assertEqual(pool.choose_url(), self.urls[2])
+        get_endpoint(self.urls[2]).breaker.trip()
+        self.assertEqual(pool.choose_url(), self.urls[0])
+
+    def test_retries_failures(self):
+        pool = EndpointPool(self.urls)
+        get_endpoint(self.urls[0]).latency = 0.1
+        get_endpoint(self.urls[1]).latency = 0.2
+        get_endpoint(self.urls[2]).latency = 0.3
+        self.responses[self.urls[0]] = requests.exceptions.ConnectionError()
+        self.responses[self.urls[1]] = FakeResponse(503)
+        r = pool.request('GET', '/state/aa')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.endpoint_url, self.urls[2])
+        self.assertEqual(len(self.calls), 3)
+        # The host refusing connections is ejected.
+        self.assertFalse(get_endpoint(self.urls[0]).breaker.available())
+
+    def test_last_failure_returned(self):
+        pool = EndpointPool(self.urls[:1])
+        self.responses[self.urls[0]] = FakeResponse(500)
+        self.assertEqual(pool.request('GET', '/state/aa').status_code, 500)
+
+    def test_head_not_found(self):
+        pool = EndpointPool(self.urls[:2])
+        get_endpoint(self.urls[0]).latency = 0.1
+        get_endpoint(self.urls[1]).latency = 0.2
+        self.responses[self.urls[0]] = FakeResponse(404, {'error': {'code': 50}})
+        r = pool.request('GET', '/state/aa', head=HEAD)
+        self.assertEqual(r.endpoint_url, self.urls[1])
+        # Other 404s are answers.
+        self.responses[self.urls[0]] = FakeResponse(404, {'error': {'code': 75}})
+        self.assertEqual(pool.request('GET', '/state/aa').status_code, 404)
+
+    def test_prefers_the_endpoint_of_the_head(self):
+        pool = EndpointPool(self.urls)
+        get_endpoint(self.urls[0]).latency = 0.1
+        get_endpoint(self.urls[1]).latency = 0.2
+        get_endpoint(self.urls[2]).latency = 5
+        remember_head(OTHER_HEAD, self.urls[2])
+        self.assertEqual(pool.request('GET', '/state/aa', head=OTHER_HEAD).endpoint_url, self.urls[2])
+        self.assertEqual(pool.request('GET', '/state/aa').endpoint_url, self.urls[0])
+
+
+class SplitAggregatesTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.aggregates = SplitAggregates()
+
+    def put(self, obj):
+        tag = HANDLER.RECORDING if isinstance(obj, Recording) else HANDLER.WORK
+        self.aggregates.update(address(obj.title, tag), obj, obj.SerializeToString())
+
+    def test_totals(self):
+        self.put(recording('Blue Moon', ('Ann', 60), ('Bob', 40)))
+        self.put(recording('Red Sky', ('Ann', 100)))
+        self.put(work('Blue Moon', ('Ann', 'Acme', 50), ('Cy', 'Acme', 50)))
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann'), {
+            'count': 2,
+            'total': 160,
+            'top': [{'title': 'Red Sky', 'split': 100}, {'title': 'Blue Moon', 'split': 60}],
+        })
+        self.assertEqual(self.aggregates.summary(PUBLISHER, 'Acme')['total'], 100)
+        self.assertEqual(self.aggregates.summary(SONGWRITER, 'Ann')['count'], 1)
+        self.assertEqual(self.aggregates.ranking(CONTRIBUTOR, limit=1), {
+            'count': 2,
+            'top': [{'name': 'Ann', 'total': 160, 'count': 2}],
+        })
+
+    def test_party_named_twice(self):
+        self.put(recording('Blue Moon', ('Ann', 30), ('Ann', 20)))
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann')['total'], 50)
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann')['count'], 1)
+
+    def test_party_named_twice_with_a_zero_split(self):
+        self.put(recording('Blue Moon', ('Ann', 0), ('Ann', 20)))
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann')['count'], 1)
+        self.aggregates.discard(address('Blue Moon', HANDLER.RECORDING))
+        self.assertEqual(self.aggregates.ranking(CONTRIBUTOR), {'count': 0, 'top': []})
+
+    def test_update_and_discard(self):
+        self.put(recording('Blue Moon', ('Ann', 60), ('Bob', 40)))
+        self.put(recording('Blue Moon', ('Ann', 100)))
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann')['total'], 100)
+        self.assertEqual(self.aggregates.ranking(CONTRIBUTOR)['count'], 1)
+        self.aggregates.discard(address('Blue Moon', HANDLER.RECORDING))
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann'), {'count': 0, 'total': 0, 'top': []})
+        self.assertEqual(self.aggregates.ranking(CONTRIBUTOR)['count'], 0)
+
+    def test_include(self):
+        self.put(recording('Blue Moon', ('Ann', 60)))
+        self.put(recording('Red Sky', ('Ann', 10)))
+        summary = self.aggregates.summary(CONTRIBUTOR, 'Ann', include=lambda title: 'Sky' in title)
+        self.assertEqual((summary['count'], summary['total']), (1, 10))
+
+    def test_refresh(self):
+        self.aggregates.refresh(FakeClient([recording('Blue Moon', ('Ann', 60)), work('Blue Moon', ('Ann', 'Acme', 50))]))
+        self.assertEqual(self.aggregates.head, HEAD)
+        self.aggregates.refresh(FakeClient([recording('Blue Moon', ('Ann', 60))]))
+        self.assertEqual(self.aggregates.summary(PUBLISHER, 'Acme')['count'], 0)
+        self.assertEqual(self.aggregates.summary(CONTRIBUTOR, 'Ann')['count'], 1)
+
+    def total(self):
+        return self.aggregates.summary(CONTRIBUTOR, 'Ann')['total']
+
+    def test_changes_applied_with_the_head(self):
+        self.aggregates.refresh(FakeClient([recording('Blue Moon', ('Ann', 20))]))
+        fake = FakeClient([recording('Blue Moon', ('Ann', 100)), recording('Red Sky', ('Ann', 80))], head=OTHER_HEAD)
+        reads = []
+
+        def entries(entries):
+            for entry in entries:
+                yield entry
+                reads.append(self.aggregates.read(self.total))
+        fake.entries[Recording] = entries(fake.entries[Recording])
+
+        self.aggregates.refresh(fake)
+        self.assertEqual(reads, [(20, HEAD), (20, HEAD)])
+        self.assertEqual(self.aggregates.read(self.total), (180, OTHER_HEAD))
+
+    def test_read_repeated_when_changes_are_applied(self):
+        self.aggregates.refresh(FakeClient([recording('Blue Moon', ('Ann', 20))]))
+        totals = []
+
+        def read():
+            totals.append(self.total())
+            if len(totals) == 1:
+                self.aggregates.refresh(FakeClient([recording('Blue Moon', ('Ann', 180))], head=OTHER_HEAD))
+            return totals[-1]
+        self.assertEqual(self.aggregates.read(read), (180, OTHER_HEAD))
+        self.assertEqual(totals, [20, 180])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SplitSummaryTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.aggregates = SplitAggregates()
+        self.omi = BlockingClient([recording('Blue Moon', ('Ann', 20))])
+        self.omi.release.set()
+        for target, name, value in (
+            (OMISTLViewSet, '_client', mock.Mock(return_value=self.omi)),
+            (views, 'get_split_aggregates', mock.Mock(return_value=self.aggregates)),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, query=''):
+        request = APIRequestFactory().get('/individuals/Ann/splits/summary' + query)
+        return IndividualsViewSet.as_view({'get': 'splits_summary'})(request, pk='Ann')
+
+    def test_first_build(self):
+        self.omi.release.clear()
+        response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '%d' % OMISTLViewSet.index_retry_after)
+        self.assertIsNone(self.aggregates.head)
+        self.omi.release.set()
+        wait_for_refresh(self.aggregates)
+        self.assertEqual(self.aggregates.head, HEAD)
+
+    def test_summary(self):
+        self.aggregates.refresh(self.omi)
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertEqual(response.data['recordings']['total'], 20)
+
+    def test_pinned_to_another_block(self):
+        self.aggregates.refresh(self.omi)
+        self.omi.head = OTHER_HEAD
+        self.omi.entries[Recording] = [(address('Blue Moon', HANDLER.RECORDING), recording('Blue Moon', ('Ann', 180)).SerializeToString())]
+        response = self.get('?head=%s' % OTHER_HEAD)
+        self.assertEqual(response['X-OMI-Head'], OTHER_HEAD)
+        self.assertEqual(response.data['recordings']['total'], 180)
+        # The split totals stay at their block.
+        self.assertEqual(self.aggregates.head, HEAD)
+        response = self.get('?head=%s' % HEAD)
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertEqual(response.data['recordings']['total'], 20)
+
+
+class SnapshotTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'registry.omisnap')
+        self.works = [work('Work %d' % i, ('Ann', 'Acme', i)) for i in range(300)]
+        self.entries = [(address(obj.title, HANDLER.WORK), obj.SerializeToString()) for obj in self.works]
+        with open(self.path, 'wb') as f:
+            writer = SnapshotWriter(f, HEAD)
+            writer.write_entries('works', self.entries)
+            writer.write_entries('individuals', [])
+            writer.close()
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63):
+            encoded = encode_varint(value)
+            self.assertEqual(decode_varint(b'x' + encoded + b'y', 1), (value, len(encoded) + 1))
+
+    def test_round_trip(self):
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.head, HEAD)
+            self.assertEqual(snapshot.count('works'), 300)
+            self.assertEqual(snapshot.count('individuals'), 0)
+            self.assertEqual(snapshot.count('recordings'), 0)
+            self.assertEqual([(a, bytes(data)) for a, data in snapshot.entries('works')], self.entries)
+            self.assertEqual(list(snapshot.entries('recordings')), [])
+            address_, data = snapshot.entry('works', 299)
+            self.assertEqual((address_, bytes(data)), self.entries[299])
+            self.assertEqual(list(snapshot.messages('works')), self.works)
+
+    def test_damaged_files(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for damaged in (b'', b'OMISNAP1', b'x' * 100, data[:len(data) // 2], data[:-60] + data[-20:]):
+            with open(self.path, 'wb') as f:
+                f.write(damaged)
+            with self.assertRaises(ValueError):
+                Snapshot(self.path)
+
+    def test_load(self):
+        index = SplitAggregates()
+        load_snapshot_file(index, self.path)
+        self.assertEqual(index.head, HEAD)
+        self.assertEqual(index.summary(PUBLISHER, 'Acme')['count'], 300)
+
+    def test_load_damaged(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'OMISNAP1')
+        index = SplitAggregates()
+        with self.assertLogs('omi_api.snapshot', 'ERROR'):
+            load_snapshot_file(index, self.path)
+        self.assertIsNone(index.head)
+
+    def test_seeds_the_first_build(self):
+        index = SplitAggregates()
+        index.snapshot_file = self.path
+        omi = BlockingClient(self.works[1:] + [work('Work 0', ('Ann', 'Acme', 5))], head=OTHER_HEAD)
+        index.ensure_fresh(omi)
+        # Reads are answered from the snapshot while catching up.
+        for _ in range(500):
+            if index.head is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(index.head, HEAD)
+        self.assertEqual(index.summary(PUBLISHER, 'Acme')['count'], 300)
+        with mock.patch.object(Work, 'FromString', wraps=Work.FromString) as from_string:
+            omi.release.set()
+            wait_for_refresh(index)
+        self.assertEqual(index.head, OTHER_HEAD)
+        # Only the entry that changed since the snapshot is decoded.
+        self.assertEqual(from_string.call_count, 1)
+
+
+class EntityStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.store = EntityStore(Recording)
+
+    def put(self, obj):
+        self.store.put(address(obj.title, HANDLER.RECORDING), obj, obj.SerializeToString())
+
+    def titles(self):
+        with self.store.lock:
+            return [self.store.get(row).title for row in self.store.rows()]
+
+    def test_rows_in_address_order(self):
+        titles = ['Recording %d' % i for i in range(20)]
+        for title in titles:
+            self.put(recording(title))
+        self.assertEqual(self.titles(), sorted(titles, key=lambda title: address(title, HANDLER.RECORDING)))
+        self.assertEqual(len(self.store), 20)
+        self.assertEqual(
+            [obj.title for obj in self.store.messages()],
+            sorted(titles, key=lambda title: address(title, HANDLER.RECORDING)),
+        )
+
+    def test_put_replaces(self):
+        self.put(Recording(title='Blue Moon', label_name='Acme'))
+        self.put(Recording(title='Blue Moon', label_name='Other'))
+        self.assertEqual(len(self.store), 1)
+        with self.store.lock:
+            row, = self.store.rows()
+            self.assertEqual(self.store.values(row, ('title', 'label_name', 'isrc')), {
+                'title': 'Blue Moon',
+                'label_name': 'Other',
+            })
+        self.assertEqual(
+            self.store.data(address('Blue Moon', HANDLER.RECORDING)),
+            Recording(title='Blue Moon', label_name='Other').SerializeToString(),
+        )
+
+    def test_remove_and_compact(self):
+        titles = ['Recording %d' % i for i in range(10)]
+        for title in titles:
+            self.put(recording(title))
+        for title in titles[:6]:
+            self.store.remove(address(title, HANDLER.RECORDING))
+        self.store.remove(address('Missing', HANDLER.RECORDING))
+        self.assertIsNone(self.store.data(address(titles[0], HANDLER.RECORDING)))
+        self.assertEqual(self.titles(), sorted(titles[6:], key=lambda title: address(title, HANDLER.RECORDING)))
+        # More removed rows than live ones, so the rows were compacted.
+        self.assertEqual(len(self.store._data), 4)
+        self.assertEqual(self.store.addresses(), {address(title, HANDLER.RECORDING) for title in titles[6:]})
+
+    def test_shared_values(self):
+        self.put(Recording(title='Blue Moon', label_name=''.join(['Ac', 'me'])))
+        self.put(Recording(title='Red Sky', label_name=''.join(['Acm', 'e'])))
+        with self.store.lock:
+            first, second = self.store.rows()
+            label = self.store.fields.index('label_name')
+            self.assertIs(self.store._columns[label][first], self.store._columns[label][second])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    OMI_REGISTRY_CACHE=True,
+)
+class RegistryListTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.registry = RegistryCache()
+        self.omi = self.client_for([work('Blue Moon', ('Ann', 'Acme', 50))])
+        for target, name, value in (
+            (OMISTLViewSet, '_client', mock.Mock(side_effect=lambda: self.omi)),
+            (views, 'get_registry_cache', mock.Mock(return_value=self.registry)),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def client_for(self, objects, head=HEAD):
+        omi = BlockingClient(objects, head=head)
+        omi.release.set()
+        # Lists read from the REST API.
+        omi.get_works = lambda head=None: FakeCursor(
+            [Work.FromString(data) for _, data in omi.entries.get(Work, [])], head or omi.head)
+        return omi
+
+    def get(self, query=''):
+        request = APIRequestFactory().get('/works/' + query)
+        response = WorksViewSet.as_view({'get': 'list'})(request)
+        return response['X-OMI-Head'], [item['title'] for item in response.data['results']]
+
+    def test_rest_api_while_building(self):
+        self.omi.release.clear()
+        self.assertEqual(self.get(), (HEAD, ['Blue Moon']))
+        self.assertIsNone(self.registry.head)
+        self.omi.release.set()
+        wait_for_refresh(self.registry)
+        self.assertEqual(self.registry.head, HEAD)
+
+    def test_changes_applied_with_the_head(self):
+        self.registry.refresh(self.omi)
+        self.omi.get_works = None
+        fake = self.client_for([work('Blue Moon', ('Ann', 'Acme', 50)), work('Red Sky', ('Ann', 'Acme', 50))], head=OTHER_HEAD)
+        reads = []
+
+        def entries(entries):
+            for entry in entries:
+                yield entry
+                reads.append(self.get())
+        fake.entries[Work] = entries(fake.entries[Work])
+
+        self.registry.refresh(fake)
+        self.assertEqual(reads, [(HEAD, ['Blue Moon'])] * 2)
+        self.assertEqual(self.get(), (OTHER_HEAD, sorted(
+            ['Blue Moon', 'Red Sky'], key=lambda title: address(title, HANDLER.WORK))))
+
+    def test_read_repeated_when_changes_are_applied(self):
+        self.registry.refresh(self.omi)
+        self.omi.get_works = None
+        filter_and_paginate_store = OMISTLViewSet._filter_and_paginate_store
+        calls = []
+
+        def read(view, request, store):
+            calls.append(store)
+            if len(calls) == 1:
+                self.registry.refresh(self.client_for([], head=OTHER_HEAD))
+            return filter_and_paginate_store(view, request, store)
+        with mock.patch.object(OMISTLViewSet, '_filter_and_paginate_store', read):
+            self.assertEqual(self.get(), (OTHER_HEAD, []))
+        self.assertEqual(len(calls), 2)
+
+    def test_pinned_to_another_block(self):
+        self.registry.refresh(self.omi)
+        self.omi = self.client_for([work('Red Sky', ('Ann', 'Acme', 50))], head=OTHER_HEAD)
+        self.assertEqual(self.get('?head=%s' % OTHER_HEAD), (OTHER_HEAD, ['Red Sky']))
+        self.assertEqual(self.get('?head=%s' % HEAD), (HEAD, ['Blue Moon']))
+
+
+class MatchExpressionTest(SimpleTestCase):
+
+    def test_words(self):
+        self.assertEqual(match_expression('Café del-Mar!'), '"Café"* "del"* "Mar"*')
+
+    def test_no_words(self):
+        self.assertIsNone(match_expression(''))
+        self.assertIsNone(match_expression(' "*- '))
+
+
+class SearchIndexTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'search.sqlite3')
+
+    def test_workers_sharing_the_file(self):
+        first = SearchIndex(self.path)
+        second = SearchIndex(self.path)
+        first.refresh(FakeClient([work('Blue Moon'), work('Red Sky')]))
+
+        # The second worker picks up the head instead of refreshing again.
+        fake = FakeClient([work('Blue Moon'), work('Red Sky')])
+        second.refresh(fake)
+        self.assertEqual(fake.calls, 0)
+        self.assertEqual(second.head, HEAD)
+        self.assertEqual(second.search('blue')[0], 1)
+
+        # Changes indexed by one worker are not indexed again by the other.
+        changed = work('Blue Moon', ('Ann', 'Acme', 100))
+        second.update(address('Blue Moon', HANDLER.WORK), changed, changed.SerializeToString())
+        second._save()
+        self.assertFalse(first.changed(address('Blue Moon', HANDLER.WORK), changed.SerializeToString()))
+        first.update(address('Blue Moon', HANDLER.WORK), changed, changed.SerializeToString())
+        first._save()
+        self.assertEqual(first.search('blue')[0], 1)
+        self.assertEqual(second.search('acme')[0], 1)
+
+    def test_refresh_while_another_worker_writes(self):
+        first = SearchIndex(self.path)
+        first.refresh(FakeClient([work('Blue Moon')]))
+        first.refreshed_at = 0
+        second = SearchIndex(self.path)
+        second.refreshed_at = 0
+        fake = FakeClient([work('Blue Moon'), work('Red Sky')], head=OTHER_HEAD)
+        with first._writing(blocking=True):
+            second.refresh(fake)
+        self.assertEqual(fake.calls, 0)
+        self.assertEqual(second.head, HEAD)
+        first.refresh(fake, head=OTHER_HEAD)
+        self.assertEqual(first.head, OTHER_HEAD)
+        self.assertEqual(second.search('red')[0], 1)
+
+    def test_refresh_committed_with_the_head(self):
+        first = SearchIndex(self.path)
+        first.commit_every = 1
+        first.refresh(FakeClient([work('Blue Moon')]))
+        second = SearchIndex(self.path)
+        seen = []
+        update = first.update
+
+        def update_and_read(*args):
+            update(*args)
+            with second.reading() as head:
+                seen.append((head, second.search('red sky')[0]))
+        with mock.patch.object(first, 'update', update_and_read):
+            first.refresh(FakeClient([work('Blue Moon'), work('Red Sky'), work('Red Sky 2')]), head=OTHER_HEAD)
+        self.assertEqual(seen, [(HEAD, 0), (HEAD, 0)])
+        with second.reading() as head:
+            self.assertEqual((head, second.search('red sky')[0]), (OTHER_HEAD, 2))
+
+    def test_reading_keeps_the_head(self):
+        first = SearchIndex(self.path)
+        first.refresh(FakeClient([work('Blue Moon')]))
+        second = SearchIndex(self.path)
+        with second.reading() as head:
+            first.refresh(FakeClient([work('Red Sky')]), head=OTHER_HEAD)
+            self.assertEqual(head, HEAD)
+            self.assertEqual((second.search('blue')[0], second.search('red')[0]), (1, 0))
+        with second.reading() as head:
+            self.assertEqual(head, OTHER_HEAD)
+            self.assertEqual((second.search('blue')[0], second.search('red')[0]), (0, 1))
+
+    def test_reopen(self):
+        SearchIndex(self.path).refresh(FakeClient([work('Blue Moon')]))
+        index = SearchIndex(self.path)
+        self.assertEqual(index.head, HEAD)
+        self.assertEqual(index.addresses(), {address('Blue Moon', HANDLER.WORK)})
+
+    def test_open_while_another_worker_builds(self):
+        first = SearchIndex(self.path)
+        opened = []
+        with first._writing(blocking=True):
+            thread = threading.Thread(target=lambda: opened.append(SearchIndex(self.path)))
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+            self.assertEqual(len(opened), 1)
+
+    def test_ranking(self):
+        index = SearchIndex(self.path)
+        index.refresh(FakeClient([
+            recording('Night Train', ('Moon Unit', 100)),
+            work('Moon River', ('Ann', 'Acme', 100)),
+            IndividualIdentity(name='Zoë Moonen'),
+        ]))
+        total, results = index.search('moon')
+        self.assertEqual(total, 3)
+        # Matches in the name come before matches in the other text.
+        self.assertEqual({result['name'] for result in results[:2]}, {'Moon River', 'Zoë Moonen'})
+        self.assertEqual(results[2]['name'], 'Night Train')
+        self.assertEqual(index.search('zoe')[0], 1)
+        self.assertEqual(index.search('moon', kinds=['recordings'])[1][0]['name'], 'Night Train')
+        self.assertEqual(index.search('moon', limit=1, offset=2)[1][0]['name'], 'Night Train')
+        self.assertEqual(index.search('moon river acme')[0], 1)
+        self.assertEqual(index.search(''), (0, []))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchViewTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.index = SearchIndex(os.path.join(self.dir, 'search.sqlite3'))
+        self.omi = BlockingClient([work('Blue Moon'), work('Red Sky')])
+        for target, name, value in (
+            (OMISTLViewSet, '_client', mock.Mock(return_value=self.omi)),
+            (views, 'get_search_index', mock.Mock(return_value=self.index)),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, query):
+        request = APIRequestFactory().get('/search/' + query)
+        return SearchViewSet.as_view({'get': 'list'})(request)
+
+    def test_first_build(self):
+        response = self.get('?q=blue')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '%d' % OMISTLViewSet.index_retry_after)
+        self.omi.release.set()
+        wait_for_refresh(self.index)
+        response = self.get('?q=blue')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-OMI-Head'], HEAD)
+        self.assertEqual([result['name'] for result in response.data['results']], ['Blue Moon'])
+
+    def test_other_head(self):
+        self.omi.release.set()
+        self.index.refresh(self.omi)
+        response = self.get('?q=blue&head=%s' % OTHER_HEAD)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': "Search is only available at head %s" % HEAD})
+        response = self.get('?q=blue&type=songs')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CreateTest(SimpleTestCase):
+    """
+    Writes of works through the views, with a mock OMIClient.
+    """
+    user = SimpleNamespace(pk=7, is_authenticated=lambda: True)
+
+    def setUp(self):
+        cache.clear()
+        self.omi = mock.Mock()
+        self.omi.set_work.return_value = self.submitted()
+        self.batch_status = mock.Mock()
+        self.batch_status.return_value.wait_for_committed.return_value = "COMMITTED"
+        for target, name, value in (
+            (OMISTLViewSet, '_client', mock.Mock(return_value=self.omi)),
+            (views, 'BatchStatus', self.batch_status),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def submitted(self):
+        status = mock.Mock(batch_id='b1', status_url='http://validator:8080/batch_status?id=b1')
+        status.wait_for_committed.return_value = "COMMITTED"
+        return status
+
+    def post(self, data=None, key=None, user=user):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        request = APIRequestFactory().post('/works/', data or {'title': 'Blue Moon'}, format='json', **headers)
+        force_authenticate(request, user=user)
+        # Also runs with the permissions of the read only profile.
+        view = WorksViewSet.as_view({'post': 'create'}, permission_classes=[])
+        return view(request)
+
+    def nonce(self, call=-1):
+        return self.omi.set_work.call_args_list[call][1]['nonce']
+
+    def test_without_key(self):
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.omi.set_work.call_count, 2)
+        self.assertIsNone(self.nonce())
+
+    def test_replayed(self):
+        response = self.post(key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        response = self.post(key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.omi.set_work.call_count, 1)
+        # The status of the batch is only waited for until it is known.
+        self.assertEqual(self.batch_status.call_count, 1)
+
+    def test_replayed_until_committed(self):
+        self.batch_status.return_value.wait_for_committed.return_value = "PENDING"
+        self.assertEqual(self.post(key='k1').status_code, 500)
+        self.batch_status.return_value.wait_for_committed.return_value = "COMMITTED"
+        response = self.post(key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.omi.set_work.call_count, 1)
+        self.batch_status.assert_called_with('b1', 'http://validator:8080/batch_status?id=b1', timeout=mock.ANY)
+
+    def test_in_progress(self):
+        responses = []
+
+        def submit(*args, **kwargs):
+            responses.append(self.post(key='k1'))
+            responses.append(self.post({'title': 'Red Sky'}, key='k1'))
+            return self.submitted()
+        self.omi.set_work.side_effect = submit
+        self.assertEqual(self.post(key='k1').status_code, 201)
+        self.assertEqual([response.status_code for response in responses], [409, 422])
+
+    def test_different_body(self):
+        self.post(key='k1')
+        response = self.post({'title': 'Red Sky'}, key='k1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.omi.set_work.call_count, 1)
+
+    def test_keys_per_user(self):
+        self.post(key='k1')
+        other = SimpleNamespace(pk=8, is_authenticated=lambda: True)
+        response = self.post({'title': 'Red Sky'}, key='k1', user=other)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertNotEqual(self.nonce(0), self.nonce(1))
+
+    def test_nonce_from_key(self):
+        self.post(key='k1')
+        scope = "7|/works/|k1"
+        self.assertEqual(self.nonce(), hashlib.sha256(scope.encode()).hexdigest())
+
+    def test_failed_submit_releases_the_key(self):
+        self.omi.set_work.side_effect = requests.exceptions.ConnectionError()
+        self.assertEqual(self.post(key='k1').status_code, 503)
+        self.omi.set_work.side_effect = None
+        response = self.post(key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(self.nonce(0), self.nonce(1))
+
+    def test_pending_key_expires(self):
+        # The worker dies before the batch is submitted.
+        self.omi.set_work.side_effect = SystemExit()
+        with self.assertRaises(SystemExit):
+            self.post(key='k1')
+        self.omi.set_work.side_effect = None
+        self.assertEqual(self.post(key='k1').status_code, 409)
+        with mock.patch('time.time', return_value=time.time() + settings.OMI_IDEMPOTENCY_PENDING_TTL + 1):
+            response = self.post(key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.omi.set_work.call_count, 2)
+
+    @override_settings(OMI_SKIP_UNCHANGED_WRITES=True)
+    def test_unchanged(self):
+        self.omi.set_work.return_value = UnchangedStatus()
+        response = self.post()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['X-OMI-Unchanged'], '1')
+        self.assertTrue(self.omi.set_work.call_args[1]['skip_unchanged'])
+        self.post(key='k1')
+        response = self.post(key='k1')
+        self.assertEqual(response['X-OMI-Unchanged'], '1')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.batch_status.assert_not_called()
+
+
+class SubmitTest(MessageTypesMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.state = {}
+        for name, value in (
+            ('signing', mock.Mock()),
+            ('get_state_data', mock.Mock(side_effect=lambda base_url, address, timeout: self.state.get(address))),
+            ('txn_payload_pb2', mock.Mock()),
+        ):
+            patcher = mock.patch.object(client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Stops once the transaction is being built.
+        client.txn_payload_pb2.OMITransactionPayload.side_effect = NotImplementedError()
+
+    def submit(self, skip_unchanged):
+        return client.submit_omi_transaction(
+            'http://validator:8080', 'key', 'SetWork', Work, 'title', {'title': 'Blue Moon'},
+            skip_unchanged=skip_unchanged,
+        )
+
+    def test_skip_unchanged(self):
+        self.state[address('Blue Moon', HANDLER.WORK)] = Work(title='Blue Moon').SerializeToString()
+        status = self.submit(skip_unchanged=True)
+        self.assertIsInstance(status, UnchangedStatus)
+        self.assertEqual(status.wait_for_committed(), "COMMITTED")
+        with self.assertRaises(NotImplementedError):
+            self.submit(skip_unchanged=False)
+
+    def test_changed(self):
+        self.state[address('Blue Moon', HANDLER.WORK)] = Work(title='Blue Moon', iswc='T-1').SerializeToString()
+        with self.assertRaises(NotImplementedError):
+            self.submit(skip_unchanged=True)
+        del self.state[address('Blue Moon', HANDLER.WORK)]
+        with self.assertRaises(NotImplementedError):
+            self.submit(skip_unchanged=True)
+
+
+class BatchStatusTest(SimpleTestCase):
+
+    def setUp(self):
+        self.status = BatchStatus('b1', 'http://validator:8080/batch_status?id=b1')
+
+    def test_check(self):
+        with mock.patch.object(client, 'rest_request', return_value=FakeResponse(body={'data': {'b1': 'PENDING'}})) as rest_request:
+            self.assertEqual(self.status.check(timeout=5), 'PENDING')
+        args, kwargs = rest_request.call_args
+        self.assertEqual(args, ('GET', 'http://validator:8080/batch_status?id=b1&wait=5'))
+        # The REST API holds the request for up to `wait` seconds.
+        self.assertEqual(kwargs['allowance'], 5)
+        self.assertEqual(kwargs['timeout'], (3.05, 15))
+
+    def test_wait_for_committed(self):
+        self.status.check = mock.Mock(side_effect=['PENDING', 'PENDING', 'COMMITTED'])
+        self.assertEqual(self.status.wait_for_committed(), 'COMMITTED')
+        self.assertEqual(self.status.check.call_count, 3)
+        self.status.check.assert_called_with(timeout=5)
+
+    def test_wait_for_committed_times_out(self):
+        self.status.check = mock.Mock(return_value='PENDING')
+        with mock.patch.object(client.time, 'time', side_effect=[0, 10, 20, 31]):
+            self.assertEqual(self.status.wait_for_committed(timeout=30), 'PENDING')
+        self.assertEqual(self.status.check.call_count, 3)
+
+    def test_invalid(self):
+        self.status.check = mock.Mock(return_value='INVALID')
+        self.assertEqual(self.status.wait_for_committed(), 'INVALID')
+        self.assertEqual(self.status.check.call_count, 1)
+
+
+class LazyImportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        sys.path.insert(0, self.path)
+        self.addCleanup(sys.path.remove, self.path)
+        self.addCleanup(sys.modules.pop, 'omi_tests_lazy', None)
+        with open(os.path.join(self.path, 'omi_tests_lazy.py'), 'w') as f:
+            f.write("import os\nos.environ['OMI_TESTS_LAZY'] = '1'\nNAME = 'lazy'\n")
+        self.addCleanup(os.environ.pop, 'OMI_TESTS_LAZY', None)
+
+    def test_loaded_on_first_use(self):
+        module = lazy_import('omi_tests_lazy')
+        self.assertIs(sys.modules['omi_tests_lazy'], module)
+        self.assertNotIn('OMI_TESTS_LAZY', os.environ)
+        self.assertEqual(module.NAME, 'lazy')
+        self.assertEqual(os.environ['OMI_TESTS_LAZY'], '1')
+
+    def test_already_imported(self):
+        self.assertIs(lazy_import('hashlib'), hashlib)
+
+    def test_missing(self):
+        module = lazy_import('omi_tests_missing')
+        self.assertIsInstance(module, MissingModule)
+        self.assertNotIn('omi_tests_missing', sys.modules)
+        with self.assertRaises(ImportError) as raised:
+            module.generate_privkey()
+        self.assertEqual(raised.exception.name, 'omi_tests_missing')
+
+    def test_missing_package(self):
+        self.assertIsInstance(lazy_import('omi_tests_missing.protobuf.work_pb2'), MissingModule)
+
+
+# Boots a read only worker with the signing module hidden, as on a replica
+# where it is not installed.
+READ_ONLY_BOOT_SCRIPT = """
+import sys
+
+
+class HideSigning:
+
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] == 'sawtooth_signing':
+            raise ImportError("No module named %r" % name, name=name)
+
+
+sys.meta_path.insert(0, HideSigning())
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+from omi_api import client
+assert isinstance(client.signing, client.MissingModule), client.signing
+assert 'sawtooth_signing' not in sys.modules
+"""
+
+
+class ReadOnlyProfileTest(SimpleTestCase):
+
+    def test_boots_without_signing(self):
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = 'omi_stl.settings'
+        env['OMI_READ_ONLY'] = '1'
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        subprocess.check_call([sys.executable, '-c', READ_ONLY_BOOT_SCRIPT], env=env, cwd=settings.BASE_DIR)
+
+
+class PrivateKeyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'omi.priv')
+
+    def test_created(self):
+        with mock.patch.object(client, 'signing') as signing:
+            signing.generate_privkey.return_value = 'key1'
+            self.assertEqual(load_private_key(self.path), 'key1')
+        self.assertEqual(os.listdir(self.dir), ['omi.priv'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_read_once(self):
+        with open(self.path, 'w') as f:
+            f.write('key1')
+        self.assertEqual(load_private_key(self.path), 'key1')
+        os.remove(self.path)
+        self.assertEqual(load_private_key(self.path), 'key1')
+
+    def test_concurrent_creators(self):
+        # Both processes generate a key before either links it into place.
+        barrier = multiprocessing.Barrier(2, timeout=10)
+        results = multiprocessing.Queue()
+
+        def create(key):
+            def generate_privkey():
+                barrier.wait()
+                return key
+            with mock.patch.object(client, 'signing', SimpleNamespace(generate_privkey=generate_privkey)):
+                results.put(client._read_or_create_key(self.path))
+
+        processes = [multiprocessing.Process(target=create, args=(key,)) for key in ('key1', 'key2')]
+        for process in processes:
+            process.start()
+        keys = [results.get(timeout=10), results.get(timeout=10)]
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        with open(self.path) as f:
+            self.assertEqual(keys, [f.read()] * 2)
+        self.assertIn(keys[0], ('key1', 'key2'))
+        self.assertEqual(os.listdir(self.dir), ['omi.priv'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
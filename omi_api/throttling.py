@@ -0,0 +1,188 @@
+# Copyright 2017 ContextLabs B.V.
+
+import time
+import uuid
+import random
+import socket
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import SimpleRateThrottle
+
+from omi_api.exceptions import ServiceUnavailable
+
+
+# Admission class of each viewset action. Scans walk the whole namespace or
+# report over all of it, writes wait for the batch to commit and reads fetch a
+# single state entry.
+ACTION_CLASSES = {
+    'list': 'scan',
+    'splits_ranking': 'scan',
+    'splits_summary': 'scan',
+    'works_ranking': 'scan',
+    'works_summary': 'scan',
+    'create': 'write',
+    'retrieve': 'read',
+}
+
+
+def admission_class(view):
+    """
+    Returns the admission class of the view action. Views can override the
+    defaults with an `admission_classes` dict.
+    """
+    action = getattr(view, 'action', None)
+    return getattr(view, 'admission_classes', {}).get(action) or ACTION_CLASSES.get(action, 'read')
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    Limits each client with a token bucket per admission class.
+
+    The rate `num/period` configured for the class in DEFAULT_THROTTLE_RATES is
+    the size of the bucket, which refills at `num` tokens per `period`. A client
+    can burst up to `num` requests and then continues at the sustained rate.
+    Clients are identified by their user, as used by IsPostAuthenticatedOrReadonly,
+    and anonymous clients by their address.
+    """
+    cache_format = 'throttle_%(scope)s_%(ident)s'
+
+    def __init__(self):
+        # The scope depends on the view action, so the rate is parsed in
+        # allow_request, as done by ScopedRateThrottle.
+        self.wait_time = None
+
+    def get_cache_key(self, request, view):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            ident = 'user-%s' % user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {
+            'scope': self.scope,
+            'ident': ident,
+        }
+
+    def allow_request(self, request, view):
+        self.scope = admission_class(view)
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        now = self.timer()
+        tokens, updated = self.cache.get(self.key, (self.num_requests, now))
+        refill = (now - updated) * self.num_requests / self.duration
+        tokens = min(self.num_requests, tokens + refill)
+        if tokens < 1:
+            self.wait_time = (1 - tokens) * self.duration / self.num_requests
+            return False
+        self.cache.set(self.key, (tokens - 1, now), self.duration)
+        return True
+
+    def get_rate(self):
+        return self.THROTTLE_RATES.get(self.scope)
+
+    def wait(self):
+        return self.wait_time
+
+
+class ConcurrencyPool:
+    """
+    Limits the number of requests of an admission class handled at once by the
+    worker processes of a gateway host sharing the Django cache.
+
+    Each of the `size` slots is a cache key, taken with an atomic cache.add and
+    held for at most `lease` seconds, so the slots of a worker that died free up
+    again. The keys include the host name, so hosts sharing a cache each have
+    their own slots and adding hosts adds capacity. When all slots are taken up to `queue` requests wait at most
+    `timeout` seconds for one to free up. Requests beyond that, or that time
+    out, are rejected with a 503 asking the client to retry after
+    `retry_after` seconds, instead of tying up a worker.
+    """
+    key_format = 'omi:pool:%(host)s:%(name)s:%(slot)s'
+    # Seconds between attempts to take a slot while waiting.
+    poll_interval = 0.05
+
+    def __init__(self, name, size, queue=0, timeout=1.0, retry_after=1, lease=60):
+        self.name = name
+        self.size = size
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.lease = lease
+        self.host = socket.gethostname()
+
+    def _key(self, slot):
+        return self.key_format % {'host': self.host, 'name': self.name, 'slot': slot}
+
+    def _take(self):
+        token = uuid.uuid4().hex
+        first = random.randrange(self.size)
+        for i in range(self.size):
+            slot = (first + i) % self.size
+            if cache.add(self._key(slot), token, self.lease):
+                return slot, token
+        return None
+
+    def _add_waiting(self, delta):
+        key = self._key('waiting')
+        # The counter expires with the lease, so counts left behind by a worker
+        # that died go away.
+        cache.add(key, 0, self.lease)
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            # Expired in between.
+            return max(delta, 0)
+
+    def acquire(self):
+        """
+        Takes a slot and returns it, to be passed to release().
+        """
+        held = self._take()
+        if held is not None:
+            return held
+        try:
+            if self._add_waiting(1) > self.queue:
+                raise ServiceUnavailable(
+                    'Too many concurrent %s requests, try again later.' % self.name,
+                    wait=self.retry_after,
+                )
+            deadline = time.time() + self.timeout
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                held = self._take()
+                if held is not None:
+                    return held
+        finally:
+            self._add_waiting(-1)
+        raise ServiceUnavailable(
+            'Timed out waiting for a %s slot, try again later.' % self.name,
+            wait=self.retry_after,
+        )
+
+    def release(self, held):
+        slot, token = held
+        key = self._key(slot)
+        # After the lease ran out the slot may belong to another request.
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    """
+    Returns the ConcurrencyPool configured for the admission class
+    in OMI_ADMISSION_POOLS, or None if the class is not limited.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            config = settings.OMI_ADMISSION_POOLS.get(name)
+            _pools[name] = ConcurrencyPool(name, **config) if config else None
+        return _pools[name]
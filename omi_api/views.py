@@ -1,22 +1,300 @@
 import re
+import json
+import time
 import urllib
+import hashlib
 
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework import viewsets
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
-from requests.exceptions import HTTPError
-from protobuf_to_dict import protobuf_to_dict
+from requests.exceptions import HTTPError, Timeout, ConnectionError as RequestsConnectionError
 
-from omi_api.client import OMIClient
+from omi_api.aggregates import CONTRIBUTOR, SONGWRITER, PUBLISHER, SplitAggregates, get_split_aggregates
+from omi_api.balancer import is_head_not_found
+from omi_api.breaker import CircuitOpenError
+from omi_api.client import OMIClient, BatchStatus, UnchangedStatus, lazy_import, load_private_key
+from omi_api.exceptions import ServiceUnavailable
+from omi_api.search import KINDS, get_search_index
+from omi_api.store import get_registry_cache
+from omi_api.throttling import admission_class, get_pool
+
+
+protobuf_to_dict = lazy_import('protobuf_to_dict')
+
+HEAD_RE = re.compile(r'^[0-9a-f]{128}$')
 
 
 class OMISTLViewSet(viewsets.ViewSet):
     headers = {
         'X-OMI-Version': '1.0',
     }
+    # Results read at a pinned block never change, so they can be cached forever.
+    pinned_headers = {
+        'Cache-Control': 'public, max-age=31536000, immutable',
+    }
+    # Sent with results served from the cache while the REST API is unavailable.
+    stale_headers = {
+        'Warning': '110 - "Response is Stale"',
+        'X-OMI-Stale': '1',
+    }
+
+    # Retry-After sent when the validator is saturated but does not say for how long.
+    validator_retry_after = 5
+    # Retry-After sent while a local index is first built.
+    index_retry_after = 5
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Runs after the throttles, so rejected clients never take up a slot.
+        pool = get_pool(admission_class(self))
+        if pool is not None:
+            self._admission_slot = pool, pool.acquire()
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # Also when an unhandled exception skips finalize_response.
+            slot = getattr(self, '_admission_slot', None)
+            if slot is not None:
+                self._admission_slot = None
+                pool, held = slot
+                pool.release(held)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, CircuitOpenError):
+            exc = ServiceUnavailable('The validator is unavailable, try again later.', wait=exc.retry_after)
+        elif isinstance(exc, (RequestsConnectionError, Timeout)):
+            exc = ServiceUnavailable('The validator is unavailable, try again later.', wait=self.validator_retry_after)
+        elif isinstance(exc, HTTPError) and exc.response is not None and exc.response.status_code in (429, 503):
+            retry_after = exc.response.headers.get('Retry-After', '')
+            exc = ServiceUnavailable(
+                'The validator is busy, try again later.',
+                wait=int(retry_after) if retry_after.isdigit() else self.validator_retry_after,
+            )
+        elif isinstance(exc, HTTPError) and exc.response is not None and exc.response.status_code >= 500:
+            exc = ServiceUnavailable('The validator is unavailable, try again later.', wait=self.validator_retry_after)
+        return super().handle_exception(exc)
+
+    def _client(self, write=False):
+        private_key = load_private_key(settings.STL_PRIVKEY_FILE) if write else None
+        return OMIClient(settings.STL_REST_URLS, private_key, timeout=settings.OMI_REST_TIMEOUT)
+
+    def _headers(self, head=None, pinned=False):
+        # Every read depends on the X-OMI-Head request header, so caches must
+        # not serve a pinned result for an unpinned request or the other way
+        # around.
+        headers = dict(self.headers, Vary='X-OMI-Head')
+        if head:
+            headers['X-OMI-Head'] = head
+        if pinned:
+            headers.update(self.pinned_headers)
+        return headers
+
+    def _parse_head(self, request):
+        """
+        Returns the block id the request is pinned to, taken from the `head`
+        query parameter or the X-OMI-Head header.
+        """
+        head = request.query_params.get('head') or request.META.get('HTTP_X_OMI_HEAD')
+        if head is None:
+            return None
+        head = head.strip().lower()
+        if not HEAD_RE.match(head):
+            raise ValueError("Invalid head %r" % head)
+        return head
+
+    def _cache_key(self, request, head, prefix='pinned'):
+        query = sorted((k, v) for k, v in request.query_params.lists() if k != 'head')
+        key = "%s|%s|%r" % (head, urllib.parse.unquote(request.path), query)
+        return 'omi:%s:%s' % (prefix, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, request, read):
+        """
+        Returns the response for a read. `read` is called with the requested
+        head, or None for the current chain head, and returns the result and
+        the block id it was read from.
+
+        Reads of the current chain head are kept in the cache for
+        OMI_STALE_TTL seconds and served from there, marked as stale, while the
+        circuit of the REST API is open, the read times out or the REST API
+        answers with a server error.
+        """
+        try:
+            head = self._parse_head(request)
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=400, headers=self._headers())
+        if head:
+            cache_key = self._cache_key(request, head)
+            result = cache.get(cache_key)
+            if result is not None:
+                return Response(result, headers=self._headers(head, pinned=True))
+        else:
+            cache_key = self._cache_key(request, None, prefix='stale')
+        try:
+            result, result_head = read(head)
+        except HTTPError as exc:
+            if is_head_not_found(exc.response):
+                return Response({'error': "Unknown head %s" % head}, status=404, headers=self._headers())
+            if exc.response.status_code == 404:
+                return Response(status=404, headers=self._headers(head))
+            if exc.response.status_code < 500:
+                raise
+            return self._stale(head, cache_key, exc)
+        except (CircuitOpenError, RequestsConnectionError, Timeout) as exc:
+            return self._stale(head, cache_key, exc)
+        if head:
+            cache.set(cache_key, result, None)
+        else:
+            cache.set(cache_key, (result, result_head, time.time()), settings.OMI_STALE_TTL)
+        return Response(result, headers=self._headers(result_head, pinned=bool(head)))
+
+    def _stale(self, head, cache_key, exc):
+        """
+        Returns the cached result of a read at the chain head, marked as stale,
+        or raises `exc` if there is none.
+        """
+        stale = None if head else cache.get(cache_key)
+        if stale is None:
+            raise exc
+        result, result_head, read_at = stale
+        headers = self._headers(result_head)
+        headers.update(self.stale_headers)
+        headers['Age'] = '%d' % max(0, time.time() - read_at)
+        return Response(result, headers=headers)
+
+    def _built(self, index, client):
+        """
+        Returns the local index, refreshed if needed. Raises ServiceUnavailable
+        while it is first built in the background.
+        """
+        index.ensure_fresh(client)
+        if index.head is None:
+            raise ServiceUnavailable('The index is being built, try again later.', wait=self.index_retry_after)
+        return index
+
+    def _list(self, request, client, get_collection):
+        def read(head):
+            if settings.OMI_REGISTRY_CACHE:
+                registry = get_registry_cache()
+                registry.ensure_fresh(client)
+                # Lists are read from the REST API while the cache is first built.
+                if registry.head is not None and (head is None or head == registry.head):
+                    result, result_head = registry.read(
+                        lambda: self._filter_and_paginate_store(request, registry.stores[self.kind]))
+                    if head is None or head == result_head:
+                        result['head'] = result_head
+                        return result, result_head
+            collection = get_collection(head=head)
+            result = self._filter_and_paginate(request, collection)
+            result['head'] = collection.fetch_head()
+            return result, result['head']
+        return self._read(request, read)
+
+    def _retrieve(self, request, client, get_item, pk):
+        def read(head):
+            return self._to_json(get_item(pk, head=head)), client.head
+        return self._read(request, read)
+
+    def _aggregate(self, request, summarize):
+        """
+        Returns the response for a split report. `summarize` is called with
+        the SplitAggregates and the requested limit and returns the result.
+        """
+        client = self._client()
+        limit, _ = self._parse_limit_offset(request)
+
+        def read(head):
+            aggregates = self._built(get_split_aggregates(), client)
+            if head is None or head == aggregates.head:
+                result, result_head = aggregates.read(lambda: summarize(aggregates, limit))
+                if head is None or head == result_head:
+                    return result, result_head
+            # Pinned to another block than the split totals are at.
+            aggregates = SplitAggregates()
+            aggregates.refresh(client, head=head)
+            return summarize(aggregates, limit), aggregates.head
+        return self._read(request, read)
+
+    def _include(self, request, field):
+        """
+        Returns a function telling whether a value of `field` matches the query,
+        or None when there is no query.
+        """
+        query = self._parse_query(request)
+        if not query:
+            return None
+        return lambda value: self._filter_item({field: value}, query)
+
+    def _create_response(self, result, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        if result == "COMMITTED":
+            return Response(status=201, headers=headers)
+        return Response({'sawtooth_batch_status': result}, status=500, headers=headers)
+
+    def _create(self, request, submit):
+        """
+        Returns the response for a write. `submit` is called with the nonce
+        and whether unchanged objects are skipped, and returns the BatchStatus.
+
+        With an Idempotency-Key header the batch is remembered for
+        OMI_IDEMPOTENCY_TTL seconds. Repeated requests with the key get the
+        status of that batch instead of submitting a new one. Until the batch
+        is submitted the key is only held for OMI_IDEMPOTENCY_PENDING_TTL
+        seconds, so a worker dying mid request does not block it for long.
+        """
+        skip_unchanged = settings.OMI_SKIP_UNCHANGED_WRITES
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if key is None:
+            status = submit(None, skip_unchanged)
+            headers = {'X-OMI-Unchanged': '1'} if isinstance(status, UnchangedStatus) else None
+            return self._create_response(status.wait_for_committed(), headers)
+
+        scope = "%s|%s|%s" % (request.user.pk, request.path, key)
+        cache_key = 'omi:idempotency:%s' % hashlib.sha256(scope.encode()).hexdigest()
+        fingerprint = hashlib.sha256(json.dumps(request.data, sort_keys=True, default=str).encode()).hexdigest()
+        ttl = settings.OMI_IDEMPOTENCY_TTL
+
+        if cache.add(cache_key, {'fingerprint': fingerprint}, settings.OMI_IDEMPOTENCY_PENDING_TTL):
+            try:
+                # The same transaction for retries that reach the validator anyway.
+                status = submit(hashlib.sha256(scope.encode()).hexdigest(), skip_unchanged)
+            except Exception:
+                cache.delete(cache_key)
+                raise
+            record = {
+                'fingerprint': fingerprint,
+                'batch_id': status.batch_id,
+                'status_url': status.status_url,
+                'result': None,
+            }
+            cache.set(cache_key, record, ttl)
+            replayed = False
+        else:
+            record = cache.get(cache_key)
+            if record is not None and record['fingerprint'] != fingerprint:
+                return Response({'error': "Idempotency-Key was used for a different request"}, status=422, headers=self.headers)
+            if record is None or 'batch_id' not in record:
+                return Response({'error': "A request with this Idempotency-Key is in progress"}, status=409, headers=self.headers)
+            replayed = True
+
+        if record['batch_id'] is None:
+            record['result'] = "COMMITTED"
+        elif record['result'] in (None, "PENDING", "UNKNOWN"):
+            status = BatchStatus(record['batch_id'], record['status_url'], timeout=settings.OMI_REST_TIMEOUT)
+            record['result'] = status.wait_for_committed()
+            cache.set(cache_key, record, ttl)
+        headers = {}
+        if replayed:
+            headers['Idempotent-Replayed'] = 'true'
+        if record['batch_id'] is None:
+            headers['X-OMI-Unchanged'] = '1'
+        return self._create_response(record['result'], headers)
 
     def _to_json(self, item):
-        return self.transform(protobuf_to_dict(item))
+        return self.transform(protobuf_to_dict.protobuf_to_dict(item))
 
     def transform(self, item):
         return item
@@ -38,7 +316,9 @@ class OMISTLViewSet(viewsets.ViewSet):
     def _parse_query(self, request):
         query = urllib.parse.urlparse(request.get_full_path()).query
         if query:
-            return urllib.parse.parse_qs(query)
+            query = urllib.parse.parse_qs(query)
+            query.pop('head', None)
+            return query
         return {}
 
     def _filter_item(self, item, query):
@@ -85,6 +365,40 @@ class OMISTLViewSet(viewsets.ViewSet):
                             return False
         return True
 
+    def _filter_columns(self, store):
+        """
+        Returns the string fields of the store that appear as is at the top
+        level of the JSON of an item.
+        """
+        return ()
+
+    def _filter_and_paginate_store(self, request, store):
+        """
+        Same as _filter_and_paginate over an EntityStore. Items are filtered on
+        the stored columns and only decoded when returned, unless the query
+        uses other fields.
+        """
+        query = self._parse_query(request)
+        columns = set(self._filter_columns(store))
+        if any(k.rstrip('!') not in columns for k in query):
+            return self._filter_and_paginate(request, store.messages())
+
+        limit, offset = self._parse_limit_offset(request)
+        total = 0
+        results = []
+        with store.lock:
+            for row in store.rows():
+                if self._filter_item(store.values(row, columns), query):
+                    if total >= offset and not len(results) >= limit:
+                        results.append(self._to_json(store.get(row)))
+                    total += 1
+        return {
+            'count': len(results),
+            'total': total,
+            'offset': offset,
+            'results': results,
+        }
+
     def _filter_and_paginate(self, request, collection):
         limit, offset = self._parse_limit_offset(request)
         query = self._parse_query(request)
@@ -108,6 +422,7 @@ class IndividualsViewSet(OMISTLViewSet):
     """
     Viewset to list all or retreive a single individual in the system.
     """
+    kind = 'individuals'
 
     def transform(self, item):
         return {
@@ -119,37 +434,55 @@ class IndividualsViewSet(OMISTLViewSet):
         Return a list of all individuals.
         """
 
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        return Response(self._filter_and_paginate(request, client.get_individuals()))
+        client = self._client()
+        return self._list(request, client, client.get_individuals)
 
     def retrieve(self, request, pk=None):
         """
         Return an individual.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        try:
-            return Response(self._to_json(client.get_individual(pk)))
-        except HTTPError as exc:
-            if exc.response.status_code == 404:
-                return Response(status=404, headers=self.headers)
-            raise
+        client = self._client()
+        return self._retrieve(request, client, client.get_individual, pk)
+
+    @list_route(methods=['get'], url_path='splits/summary')
+    def splits_ranking(self, request, *args, **kwargs):
+        """
+        Return the individuals with the largest split totals, over recordings
+        as contributor and over works as songwriter.
+        """
+        include = self._include(request, 'name')
+        return self._aggregate(request, lambda aggregates, limit: {
+            'recordings': aggregates.ranking(CONTRIBUTOR, limit, include),
+            'works': aggregates.ranking(SONGWRITER, limit, include),
+        })
+
+    @detail_route(methods=['get'], url_path='splits/summary')
+    def splits_summary(self, request, pk=None):
+        """
+        Return the split totals and largest splits of an individual, over
+        recordings as contributor and over works as songwriter.
+        """
+        include = self._include(request, 'title')
+        return self._aggregate(request, lambda aggregates, limit: {
+            'name': pk,
+            'recordings': aggregates.summary(CONTRIBUTOR, pk, limit, include),
+            'works': aggregates.summary(SONGWRITER, pk, limit, include),
+        })
 
     def create(self, request, *args, **kwargs):
         """
         Register an individual.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        status = client.set_individual(request.data)
-        if status.wait_for_committed() == "COMMITTED":
-            return Response(status=201, headers=self.headers)
-        else:
-            return Response({'sawtooth_batch_status': status}, status=500, headers=self.headers)
+        client = self._client(write=True)
+        return self._create(request, lambda nonce, skip_unchanged: client.set_individual(
+            request.data, nonce=nonce, skip_unchanged=skip_unchanged))
 
 
 class OrganizationsViewSet(OMISTLViewSet):
     """
     Viewset to list all or retreive a single organization in the system.
     """
+    kind = 'organizations'
 
     def transform(self, item):
         return {
@@ -161,41 +494,61 @@ class OrganizationsViewSet(OMISTLViewSet):
         Return a list of all organisations.
         """
 
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        return Response(self._filter_and_paginate(request, client.get_organizations()), headers=self.headers)
+        client = self._client()
+        return self._list(request, client, client.get_organizations)
 
     def retrieve(self, request, pk=None):
         """
         Return an organisations.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        try:
-            return Response(self._to_json(client.get_organization(pk)), headers=self.headers)
-        except HTTPError as exc:
-            if exc.response.status_code == 404:
-                return Response(status=404, headers=self.headers)
-            raise
+        client = self._client()
+        return self._retrieve(request, client, client.get_organization, pk)
+
+    @list_route(methods=['get'], url_path='works/summary')
+    def works_ranking(self, request, *args, **kwargs):
+        """
+        Return the organisations with the largest split totals over works as
+        publisher.
+        """
+        include = self._include(request, 'name')
+        return self._aggregate(request, lambda aggregates, limit: {
+            'works': aggregates.ranking(PUBLISHER, limit, include),
+        })
+
+    @detail_route(methods=['get'], url_path='works/summary')
+    def works_summary(self, request, pk=None):
+        """
+        Return the split totals and largest splits of an organisation over
+        works as publisher.
+        """
+        include = self._include(request, 'title')
+        return self._aggregate(request, lambda aggregates, limit: {
+            'name': pk,
+            'works': aggregates.summary(PUBLISHER, pk, limit, include),
+        })
 
     def create(self, request, *args, **kwargs):
         """
         Register an organisation.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        status = client.set_organization(request.data)
-        if status.wait_for_committed() == "COMMITTED":
-            return Response(status=201, headers=self.headers)
-        else:
-            return Response({'sawtooth_batch_status': status}, status=500, headers=self.headers)
+        client = self._client(write=True)
+        return self._create(request, lambda nonce, skip_unchanged: client.set_organization(
+            request.data, nonce=nonce, skip_unchanged=skip_unchanged))
 
 
 class WorksViewSet(OMISTLViewSet):
     """
     Viewset to list all or retreive a single work in the system.
     """
+    kind = 'works'
+    ext_fields = ("registering_pubkey", "songwriter_publisher_splits")
+
+    def _filter_columns(self, store):
+        return [field for field in store.fields if field not in self.ext_fields]
 
     def transform(self, item):
         ext = {}
-        for k in ("registering_pubkey", "songwriter_publisher_splits"):
+        for k in self.ext_fields:
             value = item.pop(k)
             if value:
                 ext[k] = value
@@ -207,41 +560,38 @@ class WorksViewSet(OMISTLViewSet):
         """
         Return a list of all works.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        return Response(self._filter_and_paginate(request, client.get_works()), headers=self.headers)
+        client = self._client()
+        return self._list(request, client, client.get_works)
 
     def retrieve(self, request, pk=None):
         """
         Return a work.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        try:
-            return Response(self._to_json(client.get_work(pk)), headers=self.headers)
-        except HTTPError as exc:
-            if exc.response.status_code == 404:
-                return Response(status=404, headers=self.headers)
-            raise
+        client = self._client()
+        return self._retrieve(request, client, client.get_work, pk)
 
     def create(self, request, *args, **kwargs):
         """
         Register a work.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        status = client.set_work(request.data)
-        if status.wait_for_committed() == "COMMITTED":
-            return Response(status=201, headers=self.headers)
-        else:
-            return Response({'sawtooth_batch_status': status}, status=500, headers=self.headers)
+        client = self._client(write=True)
+        return self._create(request, lambda nonce, skip_unchanged: client.set_work(
+            request.data, nonce=nonce, skip_unchanged=skip_unchanged))
 
 
 class RecordingsViewSet(OMISTLViewSet):
     """
     Viewset to list all or retreive a single recording in the system.
     """
+    kind = 'recordings'
+    ext_fields = ("registering_pubkey", "contributor_splits", "derived_work_splits", "overall_split")
+
+    def _filter_columns(self, store):
+        return [field for field in store.fields if field not in self.ext_fields]
 
     def transform(self, item):
         ext = {}
-        for k in ("registering_pubkey", "contributor_splits", "derived_work_splits", "overall_split"):
+        for k in self.ext_fields:
             value = item.pop(k)
             if value:
                 ext[k] = value
@@ -253,26 +603,21 @@ class RecordingsViewSet(OMISTLViewSet):
         """
         Return a list of all recording.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        return Response(self._filter_and_paginate(request, client.get_recordings()), headers=self.headers)
+        client = self._client()
+        return self._list(request, client, client.get_recordings)
 
     def retrieve(self, request, pk=None):
         """
         Return a recording.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
-        try:
-            return Response(self._to_json(client.get_recording(pk)), headers=self.headers)
-        except HTTPError as exc:
-            if exc.response.status_code == 404:
-                return Response(status=404, headers=self.headers)
-            raise
+        client = self._client()
+        return self._retrieve(request, client, client.get_recording, pk)
 
     def create(self, request, *args, **kwargs):
         """
         Register a recording.
         """
-        client = OMIClient(settings.STL_REST_URL, settings.STL_PRIVKEY)
+        client = self._client(write=True)
         data = dict(request.data)
         omi_stl_map = {
             'title': 'title',
@@ -291,9 +636,48 @@ class RecordingsViewSet(OMISTLViewSet):
             except KeyError:
                 return Response({'error': "Missing 'name' for label"}, status=400, headers=self.headers)
 
-        status = client.set_recording(data)
-        result = status.wait_for_committed()
-        if result == "COMMITTED":
-            return Response(status=201, headers=self.headers)
-        else:
-            return Response({'sawtooth_batch_status': result}, status=500, headers=self.headers)
+        return self._create(request, lambda nonce, skip_unchanged: client.set_recording(
+            data, nonce=nonce, skip_unchanged=skip_unchanged))
+
+
+class SearchViewSet(OMISTLViewSet):
+    """
+    Viewset to search works, recordings, individuals and organizations by name.
+    """
+    admission_classes = {
+        'list': 'read',
+    }
+
+    def list(self, request, *args, **kwargs):
+        """
+        Return the entities matching all words of `q`, best matches first.
+        `type` limits the results to a comma separated list of works,
+        recordings, individuals and organizations.
+        """
+        q = request.query_params.get('q', '')
+        kinds = [kind for kind in request.query_params.get('type', '').split(',') if kind]
+        for kind in kinds:
+            if kind not in KINDS.values():
+                return Response({'error': "Unknown type %r" % kind}, status=400, headers=self._headers())
+        limit, offset = self._parse_limit_offset(request)
+        client = self._client()
+        index = get_search_index()
+
+        def read(head):
+            self._built(index, client)
+            # Another worker may commit a refresh of the index at any time.
+            with index.reading() as index_head:
+                if head is not None and head != index_head:
+                    raise ValueError("Search is only available at head %s" % index_head)
+                total, results = index.search(q, kinds, limit=limit, offset=offset)
+            return {
+                'count': len(results),
+                'total': total,
+                'offset': offset,
+                'results': results,
+                'head': index_head,
+            }, index_head
+        try:
+            return self._read(request, read)
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=400, headers=self._headers())
@@ -27,6 +27,10 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
+# Read replica profile: serves reads only and leaves out the admin, sessions,
+# authentication and the signing key, so workers boot faster and smaller.
+OMI_READ_ONLY = os.environ.get('OMI_READ_ONLY', '') == '1'
+
 
 # Application definition
 
@@ -37,7 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'omi_api',
+    'omi_api.apps.OmiApiConfig',
     'rest_framework',
 ]
 
@@ -51,6 +55,19 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+if OMI_READ_ONLY:
+    INSTALLED_APPS = [
+        'django.contrib.staticfiles',
+        'omi_api.apps.OmiApiConfig',
+        'rest_framework',
+    ]
+
+    MIDDLEWARE = [
+        'django.middleware.security.SecurityMiddleware',
+        'django.middleware.common.CommonMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    ]
+
 ROOT_URLCONF = 'omi_stl.urls'
 
 TEMPLATES = [
@@ -69,6 +86,12 @@ TEMPLATES = [
     },
 ]
 
+if OMI_READ_ONLY:
+    TEMPLATES[0]['OPTIONS']['context_processors'] = [
+        'django.template.context_processors.debug',
+        'django.template.context_processors.request',
+    ]
+
 WSGI_APPLICATION = 'omi_stl.wsgi.application'
 
 
@@ -82,6 +105,22 @@ DATABASES = {
     }
 }
 
+if OMI_READ_ONLY:
+    DATABASES = {}
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# Responses for reads pinned to a block are stored here without expiry, use a
+# shared backend (e.g. memcached) to share them between workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('OMI_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('OMI_CACHE_LOCATION', 'omi-stl'),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -128,16 +167,86 @@ REST_FRAMEWORK = {
     # or allow read-only access for unauthenticated users.
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly'
-    ]
+    ],
+    # Token bucket per client and admission class, see omi_api.throttling.
+    'DEFAULT_THROTTLE_CLASSES': [
+        'omi_api.throttling.TokenBucketThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'scan': '20/min',
+        'write': '60/min',
+        'read': '50/sec',
+    },
+}
+
+if OMI_READ_ONLY:
+    REST_FRAMEWORK.update({
+        'DEFAULT_AUTHENTICATION_CLASSES': [],
+        'DEFAULT_PERMISSION_CLASSES': [
+            'omi_api.permissions.IsReadOnly',
+        ],
+        'DEFAULT_RENDERER_CLASSES': [
+            'rest_framework.renderers.JSONRenderer',
+        ],
+        'UNAUTHENTICATED_USER': None,
+    })
+
+# Concurrent requests per admission class on each gateway host, over all its
+# workers sharing the cache. Requests beyond `size` wait up to `timeout` seconds in a queue of `queue`
+# requests, the rest get a 503 with Retry-After. A slot is freed after `lease`
+# seconds if its worker dies. Point reads have their own pool so heavy scans
+# and writes cannot starve them.
+OMI_ADMISSION_POOLS = {
+    'scan': {'size': 2, 'queue': 4, 'timeout': 5, 'retry_after': 10, 'lease': 300},
+    'write': {'size': 4, 'queue': 8, 'timeout': 5, 'retry_after': 5, 'lease': 60},
+    'read': {'size': 16, 'queue': 32, 'timeout': 1, 'retry_after': 1, 'lease': 30},
 }
 
+# Comma separated urls of the REST APIs of one or more validators.
 STL_REST_URL = os.environ.get('STL_REST_URL', 'http://rest_api:8080')
+STL_REST_URLS = [url.strip() for url in STL_REST_URL.split(',') if url.strip()]
+
+# Connect and read timeouts in seconds for calls to the REST API.
+OMI_REST_TIMEOUT = (3.05, 10)
+
+# Calls to a REST API host fail fast for `reset_timeout` seconds when at least
+# half of its last calls failed or took longer than `slow_call` seconds, see
+# omi_api.breaker.CircuitBreaker.
+OMI_CIRCUIT_BREAKER = {
+    'window': 20,
+    'min_calls': 5,
+    'error_rate': 0.5,
+    'slow_call': 2.0,
+    'slow_rate': 0.5,
+    'reset_timeout': 10,
+}
+
+# Seconds reads are kept to be served stale while the REST API is unavailable.
+OMI_STALE_TTL = 24 * 60 * 60
+
+# Seconds after which the local indexes of the state, e.g. the split totals,
+# are refreshed in the background.
+OMI_INDEX_REFRESH_INTERVAL = 30
+
+# Seconds the batch submitted for an Idempotency-Key is remembered.
+OMI_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Seconds an Idempotency-Key is held for a request that has not submitted its
+# batch yet. Longer than a write takes with retries over all REST APIs.
+OMI_IDEMPOTENCY_PENDING_TTL = 60
+
+# Do not submit writes of objects the state already holds.
+OMI_SKIP_UNCHANGED_WRITES = os.environ.get('OMI_SKIP_UNCHANGED_WRITES', '') == '1'
+
+# Snapshot written with `manage.py omi_snapshot export` that the local indexes
+# are seeded from on first use, before catching up with the chain.
+OMI_SNAPSHOT_FILE = os.environ.get('OMI_SNAPSHOT_FILE')
+
+# Serve lists from an in-memory copy of the whole registry, refreshed like
+# the other local indexes, instead of scanning the REST API on every request.
+OMI_REGISTRY_CACHE = os.environ.get('OMI_REGISTRY_CACHE', '') == '1'
+
+# SQLite file of the full-text search index.
+OMI_SEARCH_INDEX = os.environ.get('OMI_SEARCH_INDEX', os.path.join(BASE_DIR, 'omi_search.sqlite3'))
+# Signing key for writes, loaded on the first write and generated if missing.
 STL_PRIVKEY_FILE = os.path.join(BASE_DIR, 'omi.privkey')
-if os.path.isfile(STL_PRIVKEY_FILE):
-    with open(STL_PRIVKEY_FILE) as f:
-        STL_PRIVKEY = f.read()
-else:
-    import sawtooth_signing as signing
-    OMI_PRIVKEY = signing.generate_privkey()
-    with open(STL_PRIVKEY_FILE, "w") as f:
-        f.write(STL_PRIVKEY)
@@ -13,11 +13,16 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.conf.urls import url, include
-from django.contrib import admin
 from omi_api.router import api_urlpatterns
 
-urlpatterns = [
-    url(r'^admin/', admin.site.urls),
-    url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
-] + api_urlpatterns
+urlpatterns = api_urlpatterns
+
+if not settings.OMI_READ_ONLY:
+    from django.contrib import admin
+
+    urlpatterns = [
+        url(r'^admin/', admin.site.urls),
+        url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
+    ] + api_urlpatterns